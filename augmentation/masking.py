@@ -1,35 +1,109 @@
 import torch as th
+import torch.distributed as dist
+
+from common import metrics
 
 
 class MHMasking:
-    def __init__(self, g, delta_g_e, delta_g_v, device):
+    """
+    Draw the edge and node masks of the proposed augmentation into the "cur" masks
+
+    Parameters
+    ----------
+    g : DistGraph
+        The distributed graph.
+    masks : MaskStore
+        Edge and node masks of the graph views.
+    delta_g_e : float or torch.Tensor
+        Proposed edge change ratio. "hash" mode also takes a batch of proposals.
+    delta_g_v : float or torch.Tensor
+        Proposed node change ratio.
+    device : torch.Device
+        Device to draw the random permutations on.
+    mode : str
+        "global" draws the masks over the whole graph on every trainer.
+        "local" masks only the nodes and edges owned by this trainer's partition, dropping
+        a share proportional to the global drop count, so every trainer writes its own shard.
+        All trainers of ``group`` have to call it together, as it waits for every shard.
+        "hash" sets a counter-based state in the mask store, from which any trainer or
+        sampler regenerates the masks; ``masks`` must be counter-based.
+    group : ProcessGroup
+        Process group the proposed ratios are gathered on. ``None`` for the default group.
+    """
+
+    def __init__(self, g, masks, delta_g_e, delta_g_v, device, mode="global", group=None):
         self.g = g
+        self.masks = masks
         self.num_nodes = g.num_nodes()
         self.num_edges = g.num_edges()
         self.delta_g_e = delta_g_e
         self.delta_g_v = delta_g_v
         self.device = device
+        self.mode = mode
+        self.group = group
 
     def __call__(self):
-        self._mh_edge_masking()
-        self._mh_node_masking()
+        if self.mode == "hash":
+            self.masks.set_state("cur", self.counter_states()[0])
+        else:
+            self._mh_edge_masking()
+            self._mh_node_masking()
+            self.masks.touch("cur")
+            if self.mode == "local":
+                # Each trainer wrote only its shard; the proposal is sampled and counted across shards.
+                with metrics.timer("mh/mask_barrier"):
+                    dist.barrier(group=self.group)
 
     def _mh_edge_masking(self):
         num_edge_drop = self.num_edges - int(self.num_edges * self.delta_g_e)
-        masking_eids = th.randperm(self.num_edges, device=self.device)[:num_edge_drop]
 
-        self.g.edata["cur_emask"] = self.g.edata["org_emask"][0:self.num_edges]
-        self.g.edata["cur_emask"][masking_eids] = 0
-        self.g.edata["org_emask"][0:self.num_edges] = 1
+        if self.mode == "local":
+            eids = self.masks.owned("emask")
+            num_edge_drop = round(len(eids) * num_edge_drop / self.num_edges)
+        else:
+            eids = th.arange(self.num_edges)
+
+        drop = th.randperm(len(eids), device=self.device)[:num_edge_drop].cpu()
+
+        cur_emask = self.masks["org", "emask"][eids]
+        cur_emask[drop] = 0
+        self.masks["cur", "emask"][eids] = cur_emask
 
     def _mh_node_masking(self):
         num_node_drop = int(self.num_nodes * self.delta_g_v)
-        masking_nids = th.randperm(self.num_nodes, device=self.device)[:num_node_drop]
 
-        self.g.ndata["cur_features"][masking_nids] = 1
+        if self.mode == "local":
+            nids = self.masks.owned("nmask")
+            num_node_drop = round(len(nids) * num_node_drop / self.num_nodes)
+        else:
+            nids = th.arange(self.num_nodes)
+
+        drop = th.randperm(len(nids), device=self.device)[:num_node_drop].cpu()
+
+        cur_nmask = self.masks["org", "nmask"][nids]
+        cur_nmask[drop] = 0
+        self.masks["cur", "nmask"][nids] = cur_nmask
+
+    def counter_states(self):
+        """
+        Counter-based mask states of the proposals, without setting any of them.
+
+        Returns
+        -------
+        List of (seed, edge drop ratios, node drop ratios) per proposal, ratios per partition.
+        """
+        delta_g_e = th.as_tensor(self.delta_g_e, dtype=th.float64).view(-1)
+        delta_g_v = th.as_tensor(self.delta_g_v, dtype=th.float64).view(-1)
+        drop_e = (self.num_edges - (self.num_edges * delta_g_e).long()) / self.num_edges
+        drop_v = (self.num_nodes * delta_g_v).long() / self.num_nodes
 
-        self.g.ndata["cur_nmask"] = self.g.edata["org_nmask"][0:self.num_nodes]
-        self.g.ndata["cur_nmask"][masking_nids] = 0
-        self.g.ndata["org_nmask"][0:self.num_nodes] = 1
+        # Every partition drops its own share, at the ratio its trainers proposed,
+        # so that all trainers take the same decision for any ID.
+        ratios = th.stack([drop_e, drop_v], dim=1).unsqueeze(0)
+        gathered = [th.zeros_like(ratios) for _ in range(dist.get_world_size(self.group))]
+        with metrics.timer("mh/collective"):
+            dist.all_gather(gathered, ratios, group=self.group)
+        num_partitions = self.g.get_partition_book().num_partitions()
+        ratios = th.cat(gathered).view(num_partitions, -1, len(drop_e), 2).mean(1)
 
-        self.g.ndata["cur_features"][masking_nids] = 0
+        return [(self.masks.next_seed(), ratios[:, k, 0], ratios[:, k, 1]) for k in range(len(drop_e))]
@@ -0,0 +1,73 @@
+import argparse
+import timeit
+
+import torch as th
+import torch.nn as nn
+import torch.nn.functional as F
+
+from training.loss import FusedLoss, HLoss, JensenShannon, XeLoss
+
+
+def bench_loss(num_data, n_classes, kl, h, number):
+    """
+    Check FusedLoss against the separate loss classes, then time both.
+
+    Parameters
+    ----------
+    num_data : int
+        Number of predictions per view.
+    n_classes : int
+        Number of classes.
+    kl : float
+        Weight of the consistency loss.
+    h : float
+        Weight of the entropy loss.
+    number : int
+        Number of timed steps per configuration.
+    """
+    th.manual_seed(0)
+    labels = th.randint(n_classes, (num_data,))
+
+    def separate(pred, prev_pred, cur_pred, option_loss, kl_loss_opt):
+        loss_xe = nn.CrossEntropyLoss()(prev_pred, labels)
+        if option_loss == 0:
+            loss_kl = XeLoss()(prev_pred, F.one_hot(labels, n_classes).float())
+        elif kl_loss_opt:
+            loss_kl = JensenShannon()(prev_pred.detach(), cur_pred)
+        else:
+            loss_kl = JensenShannon()(prev_pred, cur_pred.detach())
+        return loss_xe + kl * loss_kl + h * HLoss()(pred)
+
+    def fused(pred, prev_pred, cur_pred, option_loss, kl_loss_opt):
+        return FusedLoss(n_classes, kl, h, option_loss)(pred, prev_pred, cur_pred, labels, kl_loss_opt)[0]
+
+    for option_loss, kl_loss_opt in [(0, False), (1, False), (1, True)]:
+        logits = [th.randn(num_data, n_classes, dtype=th.float64, requires_grad=True) for _ in range(3)]
+        results = []
+        for loss_fn in (separate, fused):
+            for x in logits:
+                x.grad = None
+            loss = loss_fn(*logits, option_loss, kl_loss_opt)
+            loss.backward()
+            results.append([loss.detach()] + [x.grad if x.grad is not None else th.zeros_like(x) for x in logits])
+        for expected, actual in zip(*results):
+            assert th.allclose(expected, actual, atol=1e-10), (option_loss, kl_loss_opt)
+
+        logits = [x.detach().float().requires_grad_() for x in logits]
+        for loss_fn in (separate, fused):
+            seconds = timeit.timeit(lambda: loss_fn(*logits, option_loss, kl_loss_opt).backward(), number=number)
+            print(f"option_loss {option_loss}, kl_loss_opt {kl_loss_opt}, {loss_fn.__name__}: "
+                  f"{seconds / number * 1e6:.1f} us per step")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and time FusedLoss against the separate losses")
+    parser.add_argument("--num_data", type=int, default=1000)
+    parser.add_argument("--n_classes", type=int, default=7)
+    parser.add_argument("--kl", type=float, default=0.5)
+    parser.add_argument("--h", type=float, default=0.2)
+    parser.add_argument("--number", type=int, default=200,
+        help="Number of timed steps per loss and configuration.")
+    args = parser.parse_args()
+
+    bench_loss(args.num_data, args.n_classes, args.kl, args.h, args.number)
@@ -0,0 +1,115 @@
+import os
+
+import dgl
+import numpy as np
+import torch as th
+
+
+class BlockStore:
+    """
+    Sampled blocks of every seed batch of one epoch, kept to be served in the next one
+
+    Batches written during an epoch become readable when the next epoch starts, so the blocks
+    sampled on the "cur" masks can be reused as the "prev" blocks once the masks are promoted.
+    Every epoch is tagged with the mask version it was sampled on; a batch is only served to
+    a reader expecting the same version and the same seeds.
+
+    Parameters
+    ----------
+    spill_dir : str
+        Directory of the memory-mapped files the blocks are spilled to. ``None`` keeps them in memory.
+    """
+
+    def __init__(self, spill_dir=None):
+        self.spill_dir = spill_dir
+        self.reading, self.writing = {}, {}
+        self.read_version, self.write_version = None, None
+        self._num_epochs = 0
+        self._file = None
+        self._mmap = None
+        self._offset = 0
+
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def start_epoch(self, version):
+        """
+        Make the batches written so far readable and start writing batches sampled on ``version``.
+        """
+        self.reading, self.read_version = self.writing, self.write_version
+        self.writing, self.write_version = {}, version
+
+        if self.spill_dir is not None:
+            if self._file is not None:
+                self._file.close()
+                self._mmap = np.memmap(self._path(self._num_epochs - 1), dtype=np.int64, mode="r") \
+                    if self._offset > 0 else None
+            # Two files alternate, one read while the other is written.
+            self._file = open(self._path(self._num_epochs), "wb")
+            self._offset = 0
+        self._num_epochs += 1
+
+    def put(self, step, input_nodes, output_nodes, blocks):
+        if self.spill_dir is None:
+            self.writing[step] = (input_nodes, output_nodes, blocks)
+            return
+        packed = _pack(blocks).numpy()
+        packed.tofile(self._file)
+        self.writing[step] = (self._offset, len(packed))
+        self._offset += len(packed)
+
+    def get(self, step, output_nodes, version):
+        """
+        Blocks written for a batch in the last epoch, or ``None`` if they cannot be reused.
+
+        Returns
+        -------
+        Input nodes, output nodes and blocks, in the same layout as ``NeighborSampler.sample``.
+        """
+        if version != self.read_version or step not in self.reading:
+            return None
+        if self.spill_dir is None:
+            input_nodes, stored_output_nodes, blocks = self.reading[step]
+        else:
+            offset, length = self.reading[step]
+            blocks = _unpack(th.from_numpy(np.array(self._mmap[offset:offset + length])))
+            input_nodes = blocks[0].srcdata[dgl.NID]
+            stored_output_nodes = blocks[-1].dstdata[dgl.NID]
+        if not th.equal(stored_output_nodes, output_nodes):
+            return None
+        return input_nodes, output_nodes, blocks
+
+    def _path(self, epoch):
+        return os.path.join(self.spill_dir, f"blocks_{epoch % 2}.bin")
+
+
+def _pack(blocks):
+    """
+    Flatten sampled blocks into one int64 tensor: a header of block sizes, then per block
+    the edge endpoints, the source node IDs and the edge IDs.
+    """
+    header = [len(blocks)]
+    body = []
+    for block in blocks:
+        src, dst = block.edges()
+        header += [block.num_src_nodes(), block.num_dst_nodes(), block.num_edges()]
+        body += [src, dst, block.srcdata[dgl.NID], block.edata[dgl.EID]]
+    return th.cat([th.tensor(header)] + [x.long() for x in body])
+
+
+def _unpack(packed):
+    num_blocks = int(packed[0])
+    sizes = packed[1:1 + 3 * num_blocks].view(num_blocks, 3).tolist()
+    pos = 1 + 3 * num_blocks
+    blocks = []
+    for num_src, num_dst, num_edges in sizes:
+        src, dst, nids, eids = th.split(packed[pos:pos + 3 * num_edges + num_src],
+                                        [num_edges, num_edges, num_src, num_edges])
+        pos += 3 * num_edges + num_src
+        block = dgl.create_block((src, dst), num_src_nodes=num_src, num_dst_nodes=num_dst)
+        # Destination nodes come first among the source nodes of a sampled block.
+        block.srcdata[dgl.NID] = nids
+        block.dstdata[dgl.NID] = nids[:num_dst]
+        block.edata[dgl.EID] = eids
+        blocks.append(block)
+    return blocks
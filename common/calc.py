@@ -19,3 +19,40 @@ def one_hot_encode(labels, num_classes):
     one_hot = th.zeros(labels.size(0), num_classes, device=labels.device)
     one_hot.scatter_(1, labels.unsqueeze(1), 1)
     return one_hot
+
+
+# SplitMix64 constants as signed 64-bit integers.
+_GAMMA = -7046029254386353131
+_MIX1 = -4658895280553007687
+_MIX2 = -7723592293110705685
+
+
+def _int64(x):
+    x &= (1 << 64) - 1
+    return x - (1 << 64) if x >= (1 << 63) else x
+
+
+def _shr(x, k):
+    """
+    Logical right shift of an int64 tensor.
+    """
+    return (x >> k) & ((1 << (64 - k)) - 1)
+
+
+def uniform_hash(ids, seed, stream=0):
+    """
+    Counter-based uniform random numbers, one per ID, that any process can regenerate.
+
+    Parameters:
+    - ids (torch.Tensor): Integer IDs (counters).
+    - seed (int): Seed of the random stream.
+    - stream (int): Sub-stream, e.g. to keep node and edge IDs apart.
+
+    Returns:
+    - torch.Tensor: float64 numbers in [0, 1), a pure function of (seed, stream, id).
+    """
+    z = (ids.long() + 1) * _GAMMA + _int64(seed * _MIX1 + stream * _MIX2)
+    z = (z ^ _shr(z, 30)) * _MIX1
+    z = (z ^ _shr(z, 27)) * _MIX2
+    z = z ^ _shr(z, 31)
+    return _shr(z, 11).double() / float(1 << 53)
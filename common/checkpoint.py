@@ -0,0 +1,144 @@
+import copy
+import os
+import random
+import threading
+
+import numpy as np
+import torch as th
+import torch.distributed as dist
+
+from common.rpc import RPC_LOCK
+
+
+def _rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": th.get_rng_state()}
+    if th.cuda.is_available():
+        # Dropout on the GPU draws from the CUDA generators.
+        state["cuda"] = th.cuda.get_rng_state_all()
+    return state
+
+
+def _set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    th.set_rng_state(state["torch"])
+    if "cuda" in state and th.cuda.is_available():
+        th.cuda.set_rng_state_all(state["cuda"])
+
+
+def _pack(rows):
+    # Masks only hold zeros and ones, so they are stored at one bit per ID.
+    values = (rows > 0).view(-1).numpy()
+    return np.packbits(values), len(values)
+
+
+def _unpack(packed):
+    values, length = packed
+    return th.from_numpy(np.unpackbits(values)[:length].astype(np.bool_))
+
+
+def _save(obj, path):
+    # Written next to the target and renamed, so a crash never leaves a torn checkpoint.
+    th.save(obj, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+class Checkpointer:
+    """
+    Periodic checkpoints written by a background thread
+
+    ``save`` copies the state to save and returns; the mask shards are packed and the files
+    are written while training goes on. Rank 0 writes the model and optimizer state to ``model.pt``, and every rank
+    writes its own mask shards, MH chain state and RNG state to ``rank<rank>.pt``.
+
+    Parameters
+    ----------
+    directory : str
+        Checkpoint directory on local disk.
+    rank : int
+        Rank of this trainer.
+    """
+
+    def __init__(self, directory, rank):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.rank = rank
+        self._thread = None
+
+    def save(self, epoch, model, optimizer, masks):
+        """
+        Checkpoint the state after ``epoch`` training epochs.
+
+        Parameters
+        ----------
+        epoch : int
+            Number of finished epochs.
+        model : torch.nn.Module
+            The trained model, without the DDP wrapper.
+        optimizer : torch.optim.Optimizer
+            Its optimizer.
+        masks : MaskStore
+            Mask registry, which holds the state of the MH chain.
+        """
+        # One checkpoint in flight at a time.
+        self.wait()
+        with RPC_LOCK:
+            rank_state = {"epoch": epoch, "masks": masks.state_dict(), "rng": _rng_state()}
+        model_state = None
+        if self.rank == 0:
+            model_state = {"epoch": epoch,
+                           "model": {k: v.detach().cpu().clone() for k, v in model.state_dict().items()},
+                           "optimizer": copy.deepcopy(optimizer.state_dict())}
+        self._thread = threading.Thread(target=self._write, args=(rank_state, model_state), daemon=True)
+        self._thread.start()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _write(self, rank_state, model_state):
+        shards = rank_state["masks"]["shards"]
+        for name in shards:
+            shards[name] = _pack(shards[name])
+        _save(rank_state, os.path.join(self.directory, f"rank{self.rank}.pt"))
+        if model_state is not None:
+            _save(model_state, os.path.join(self.directory, "model.pt"))
+
+
+def resume(directory, rank, model, optimizer, masks):
+    """
+    Restore a checkpoint written by ``Checkpointer``. All ranks have to call it.
+
+    The model and optimizer state are read by rank 0 and broadcast. The MH chain continues
+    from the restored masks, so no warmup augmentation is needed.
+
+    Returns
+    -------
+    int
+        Number of epochs finished before the checkpoint.
+    """
+    model_state = [None]
+    if rank == 0:
+        model_state = [th.load(os.path.join(directory, "model.pt"))]
+    dist.broadcast_object_list(model_state, src=0)
+    model.load_state_dict(model_state[0]["model"])
+    optimizer.load_state_dict(model_state[0]["optimizer"])
+
+    rank_state = th.load(os.path.join(directory, f"rank{rank}.pt"))
+    shards = rank_state["masks"]["shards"]
+    for name in shards:
+        shards[name] = _unpack(shards[name])
+    if rank_state["epoch"] != model_state[0]["epoch"]:
+        raise RuntimeError(f"Checkpoint of rank {rank} is from epoch {rank_state['epoch']}, "
+                           f"the model from epoch {model_state[0]['epoch']}")
+    with RPC_LOCK:
+        masks.load_state_dict(rank_state["masks"])
+    # A background proposal may have drawn more counter-based seeds on some ranks before the
+    # checkpoint; continuing from the largest count keeps the seeds equal and unused.
+    num_states = th.tensor([masks.num_states])
+    dist.all_reduce(num_states, op=dist.ReduceOp.MAX)
+    masks.num_states = int(num_states.item())
+    _set_rng_state(rank_state["rng"])
+    dist.barrier()
+    return rank_state["epoch"]
@@ -0,0 +1,43 @@
+import torch as th
+
+from common.seed_index import SeedIndex
+
+
+class EntropyCache:
+    """
+    Normalized prediction entropy of the training seeds, kept as a side effect of training
+
+    The training loop writes the entropy of every seed batch it predicts, and ``mh_aug``
+    reads it instead of running the model again. Entries are float16, by position in
+    ``train_nid``, and remember the epoch they were written in.
+
+    Parameters
+    ----------
+    train_nid : torch.Tensor
+        Training node IDs of this trainer.
+    refresh : int
+        Number of epochs an entry stays valid after it was written.
+    """
+
+    def __init__(self, train_nid, refresh=1):
+        self.seed_index = SeedIndex(train_nid)
+        self.refresh = refresh
+        self.epoch = 0
+        self.values = th.zeros(len(train_nid), dtype=th.float16)
+        # Epoch each entry was written in, -1 while it is empty.
+        self.epochs = th.full((len(train_nid),), -1, dtype=th.int32)
+
+    def update(self, seeds, ent):
+        pos = self.seed_index(seeds)
+        self.values[pos] = ent.detach().to("cpu", th.float16)
+        self.epochs[pos] = self.epoch
+
+    def fresh(self, seeds):
+        """
+        Whether the entries of the given seeds are valid.
+        """
+        epochs = self.epochs[self.seed_index(seeds)]
+        return (epochs >= 0) & (self.epoch - epochs <= self.refresh)
+
+    def __call__(self, seeds):
+        return self.values[self.seed_index(seeds)].float()
@@ -0,0 +1,116 @@
+import dgl
+import torch as th
+
+from common.rpc import RPC_LOCK
+
+
+class FeatureCache:
+    """
+    Per-trainer cache of node feature rows in front of a feature DistTensor
+
+    The static tier is filled at startup with the halo nodes of the local partition that have
+    the highest in-degree, since those are the remote rows sampled over and over. An optional
+    LRU tier takes the rest of the budget and keeps recently missed rows. Rows of the local
+    partition are never cached; the graph server already holds them in shared memory.
+
+    Reads go through ``__getitem__`` like a DistTensor, so the cache can replace the feature
+    tensor wherever rows are gathered. Only hit rows are served locally; misses are gathered
+    from the DistTensor in one request.
+
+    Parameters
+    ----------
+    g : DistGraph
+        The distributed graph.
+    features : DistTensor
+        Feature data of all the nodes.
+    budget_mb : float
+        Memory budget of the cached rows, in megabytes.
+    lru_fraction : float
+        Share of the budget given to the LRU tier.
+    """
+
+    def __init__(self, g, features, budget_mb, lru_fraction=0.0):
+        self.features = features
+        row_bytes = features.shape[1] * th.tensor([], dtype=features.dtype).element_size()
+        num_rows = int(budget_mb * 1024 * 1024 // row_bytes)
+        self.num_lru = int(num_rows * lru_fraction)
+
+        local_g = g.local_partition
+        halo = local_g.ndata[dgl.NID][~local_g.ndata["inner_node"].bool()]
+        num_static = min(num_rows - self.num_lru, len(halo))
+        static = halo[th.argsort(g.in_degrees(halo), descending=True)[:num_static]]
+        self.num_static = num_static
+
+        # Slot of every node ID in ``rows``, -1 when it is not cached.
+        self.slots = th.full((g.num_nodes(),), -1, dtype=th.int32)
+        self.slots[static] = th.arange(num_static, dtype=th.int32)
+        self.rows = th.empty((num_static + self.num_lru, features.shape[1]), dtype=features.dtype)
+        self.rows[:num_static] = features[static]
+
+        # Node ID held by every LRU slot and the lookup it was last used in.
+        self.lru_nids = th.full((self.num_lru,), -1, dtype=th.int64)
+        self.lru_used = th.zeros(self.num_lru, dtype=th.int64)
+        self.num_lookups = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __getitem__(self, ids):
+        with RPC_LOCK:
+            self.num_lookups += 1
+            slots = self.slots[ids].long()
+            hit = slots >= 0
+
+            rows = th.empty((len(ids), self.rows.shape[1]), dtype=self.rows.dtype)
+            rows[hit] = self.rows[slots[hit]]
+            lru_hit = slots[hit & (slots >= self.num_static)] - self.num_static
+            self.lru_used[lru_hit] = self.num_lookups
+
+            miss_ids = ids[~hit]
+            if len(miss_ids) > 0:
+                rows[~hit] = self.features[miss_ids]
+                if self.num_lru > 0:
+                    self._admit(miss_ids, rows[~hit])
+
+            self.hits += int(hit.sum())
+            self.misses += len(miss_ids)
+            return rows
+
+    def _admit(self, ids, rows):
+        """
+        Put missed rows into the least recently used LRU slots.
+        """
+        ids, first = _unique_first(ids)
+        num_admit = min(len(ids), self.num_lru)
+        ids, rows = ids[:num_admit], rows[first[:num_admit]]
+
+        victims = th.topk(self.lru_used, num_admit, largest=False).indices
+        evicted = self.lru_nids[victims]
+        self.slots[evicted[evicted >= 0]] = -1
+
+        self.lru_nids[victims] = ids
+        self.lru_used[victims] = self.num_lookups
+        self.slots[ids] = (victims + self.num_static).int()
+        self.rows[victims + self.num_static] = rows
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    @property
+    def shape(self):
+        return self.features.shape
+
+    @property
+    def dtype(self):
+        return self.features.dtype
+
+
+def _unique_first(ids):
+    """
+    Unique IDs and the position of the first occurrence of each.
+    """
+    unique_ids, inverse = th.unique(ids, return_inverse=True)
+    first = th.full((len(unique_ids),), len(ids), dtype=th.int64)
+    first.scatter_reduce_(0, inverse, th.arange(len(ids)), reduce="amin")
+    return unique_ids, first
@@ -1,23 +1,397 @@
+import queue
+import threading
+
 import dgl
+import torch as th
+
+from common.masked_features import MaskedFeatures
+from common.rpc import RPC_LOCK, locked
+from common import metrics
+from common.seed_order import cluster_permutation
+
+_END = object()
+
+
+class MaskedNeighborSampler(dgl.dataloading.NeighborSampler):
+    """
+    NeighborSampler restricted to the edge mask of a graph view in a ``MaskStore``
+
+    The mask name is looked up on every use, so the sampler follows promotions in the store.
+
+    Parameters
+    ----------
+    fanouts : List[int]
+        Number of sampled neighbors per layer.
+    masks : MaskStore
+        The mask registry.
+    view : str
+        Graph view whose edge mask restricts sampling, e.g. "prev" or "cur".
+    """
+
+    def __init__(self, fanouts, masks, view, **kwargs):
+        self.masks = masks
+        self.view = view
+        super().__init__(fanouts, mask=masks.name(view, "emask"), **kwargs)
+
+    @property
+    def prob(self):
+        return self.masks.name(self.view, "emask")
+
+    @prob.setter
+    def prob(self, value):
+        # Resolved from the mask store instead.
+        pass
 
 
 class AugDataLoader:
-    def __init__(self, g, samplers, train_nid, batch_size, shuffle=False, drop_last=False, device=None):
+    """
+    Sample every seed batch on the original graph and on the prev/cur graph views
+
+    Parameters
+    ----------
+    g : DistGraph
+        The distributed graph.
+    samplers : List[NeighborSampler]
+        Samplers of the org, prev and cur views.
+    train_nid : torch.Tensor
+        Seed node IDs.
+    batch_size : int
+        Number of seeds per batch.
+    shuffle : bool
+        Shuffle the seeds every epoch.
+    drop_last : bool
+        Drop the last incomplete batch.
+    device : torch.Device
+        Device the sampled blocks are put on.
+    fused : bool
+        Derive the prev/cur views by filtering the org sample with the edge masks.
+    features : dict[str, DistTensor or MaskedFeatures]
+        Input features of each view, all reading the same DistTensor. When given, every view
+        also carries the features of its input nodes and the labels of its seeds, so the
+        training loop gets ready-to-use tensors.
+    labels : DistTensor
+        Labels of all nodes, gathered along with ``features``.
+    prefetch : int
+        Number of batches prepared ahead by a background thread. 0 prepares them on demand.
+    block_store : BlockStore
+        Keeps the cur blocks of every batch and serves them as its prev blocks in the next
+        epoch, when the promoted masks are unchanged. Needs an unshuffled seed order.
+    cluster_shuffle : bool
+        Shuffle the order of whole batches every epoch, keeping the seeds of each batch
+        together, for seeds given in locality order.
+    feature_dtype : torch.dtype
+        Type the gathered input features are stored in, e.g. ``torch.bfloat16``. ``None`` keeps it.
+    """
+
+    def __init__(self, g, samplers, train_nid, batch_size, shuffle=False, drop_last=False, device=None,
+                 fused=False, features=None, labels=None, prefetch=0, block_store=None, cluster_shuffle=False,
+                 feature_dtype=None):
+        assert block_store is None or not shuffle
+        assert not (shuffle and cluster_shuffle)
         self.g = g
         self.samplers = samplers
+        self.fused = fused
+        self.features = features
+        self.labels = labels
+        self.prefetch = prefetch
+        self.block_store = block_store
+        self.cluster_shuffle = cluster_shuffle
+        self.feature_dtype = feature_dtype
+        self.batch_size = batch_size
+        self.train_nid = train_nid
+        # All views are sampled in one job, in DGL's sampler processes when there are any.
+        # Kept prev blocks make the prev sampling pass unnecessary in the common case.
+        self.composite = CompositeSampler(samplers if block_store is None else samplers[:1] + samplers[2:],
+                                          fused=fused)
+        # Cluster shuffling rewrites the loader's seed tensor every epoch. It gets a copy of its own,
+        # as ``train_nid`` is shared with the augmentation and stays in locality order.
         self.org_dataloader = dgl.dataloading.DistNodeDataLoader(
-            g, train_nid, self.samplers[0],
+            g, train_nid.clone() if cluster_shuffle else train_nid, self.composite,
             batch_size=batch_size, shuffle=shuffle, drop_last=drop_last, device=device)
 
     def __iter__(self):
+        if self.prefetch > 0:
+            return self._prefetched()
         return self._generator()
 
+    def _sync_workers(self):
+        """
+        Hand the current masks to the sampler processes.
+
+        Sampler processes work on a pickled copy of the collate function, which carries the
+        mask pointers and counter-based states of the time it was registered. Registering it
+        again after the masks change (promotion, a newly accepted proposal) refreshes the copy;
+        without sampler processes the samplers are used in place and see the masks directly.
+        """
+        loader = self.org_dataloader
+        if loader.pool is not None:
+            loader.pool.set_collate_fn(loader.collate_fn, loader.name)
+
     def _generator(self):
-        for step, (src_nodes, dst_nodes, blocks) in enumerate(self.org_dataloader):
-            org_src_nodes, org_dst_nodes, org_blocks = src_nodes, dst_nodes, blocks
-            prev_src_nodes, prev_dst_nodes, prev_blocks = self.samplers[1].sample(self.g, dst_nodes)
-            cur_src_nodes, cur_dst_nodes, cur_blocks = self.samplers[2].sample(self.g, dst_nodes)
-
-            yield {"org": [org_src_nodes, org_dst_nodes, org_blocks],
-                   "prev": [prev_src_nodes, prev_dst_nodes, prev_blocks],
-                   "cur": [cur_src_nodes, cur_dst_nodes, cur_blocks]}
+        with RPC_LOCK:
+            self._sync_workers()
+        if self.block_store is not None:
+            self.block_store.start_epoch(self.samplers[2].masks.version("cur"))
+        if self.cluster_shuffle:
+            # The loader serves its own seed tensor in order, so it is permuted in place,
+            # always starting from the untouched locality order.
+            self.org_dataloader.dataset[:] = \
+                self.train_nid[cluster_permutation(len(self.train_nid), self.batch_size)]
+        for step, (_, _, sampled) in enumerate(locked(self.org_dataloader)):
+            with RPC_LOCK:
+                batch = self._views(step, sampled)
+            yield batch
+
+    def _views(self, step, sampled):
+        (org_src_nodes, org_dst_nodes, org_blocks), (cur_src_nodes, cur_dst_nodes, cur_blocks) = \
+            sampled[0], sampled[-1]
+
+        if self.block_store is None:
+            prev_src_nodes, prev_dst_nodes, prev_blocks = sampled[1]
+        else:
+            # Last epoch's cur blocks, if its masks were promoted to prev unchanged.
+            prev = self.block_store.get(step, org_dst_nodes, self.samplers[1].masks.version("prev"))
+            if prev is None:
+                prev = self.composite.sample_views(self.g, self.samplers[1:2], org_dst_nodes, org_blocks)[0]
+            prev_src_nodes, prev_dst_nodes, prev_blocks = prev
+
+        if self.block_store is not None:
+            self.block_store.put(step, cur_src_nodes, cur_dst_nodes, cur_blocks)
+
+        views = {"org": [org_src_nodes, org_dst_nodes, org_blocks],
+                 "prev": [prev_src_nodes, prev_dst_nodes, prev_blocks],
+                 "cur": [cur_src_nodes, cur_dst_nodes, cur_blocks]}
+        if self.features is not None:
+            # All views share the seeds, so their labels are gathered once.
+            batch_labels = self.labels[org_dst_nodes].long()
+            for view, inputs in zip(views, self._gather_inputs([nodes for nodes, _, _ in views.values()])):
+                views[view] += [inputs, batch_labels]
+        return views
+
+    def _gather_inputs(self, input_nodes):
+        """
+        Input features of every view, fetched in one request for the union of their input nodes.
+
+        The masked views mostly repeat the nodes of the unmasked one, so each row is sent
+        over the network once and the views index into the shared rows locally.
+        """
+        features = list(self.features.values())
+        # Masks are applied per view below, so the rows are read unmasked, through a FeatureCache if any.
+        source = features[0].features if isinstance(features[0], MaskedFeatures) else features[0]
+        unique_nodes, index = th.unique(th.cat(input_nodes), return_inverse=True)
+        with metrics.timer("loader/fetch"):
+            shared = source[unique_nodes]
+        metrics.count("loader/fetched_rows", len(unique_nodes))
+
+        inputs = []
+        for view_features, view_index, view_nodes in zip(
+                features, th.split(index, [len(nodes) for nodes in input_nodes]), input_nodes):
+            rows = shared[view_index]
+            if isinstance(view_features, MaskedFeatures):
+                rows = view_features.apply(rows, view_nodes)
+            inputs.append(rows if self.feature_dtype is None else rows.to(self.feature_dtype))
+        return inputs
+
+    def _prefetched(self):
+        """
+        Run the generator in a background thread, ``prefetch`` batches ahead of the consumer.
+        """
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def work():
+            try:
+                for batch in self._generator():
+                    while not stop.is_set():
+                        try:
+                            batches.put(batch, timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
+                    if stop.is_set():
+                        return
+                batches.put(_END)
+            except Exception as e:
+                batches.put(e)
+
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is _END:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+class CompositeSampler(dgl.dataloading.Sampler):
+    """
+    Sample a seed batch on the original graph and on masked graph views in one job
+
+    Given to ``DistNodeDataLoader`` as its sampler, so that with ``--num_samplers`` > 0 every
+    view is sampled in DGL's sampler processes, in parallel with the trainer's compute.
+
+    Parameters
+    ----------
+    samplers : List[NeighborSampler]
+        Sampler of the original graph, then the ``MaskedNeighborSampler`` of every view.
+    fused : bool
+        Derive the masked views by filtering the unmasked sample with the edge masks.
+    """
+
+    def __init__(self, samplers, fused=False):
+        super().__init__()
+        self.samplers = samplers
+        self.fused = fused
+
+    def sample(self, g, seed_nodes):
+        """
+        Returns
+        -------
+        Input and output nodes of the unmasked sample, and the (input nodes, output nodes,
+        blocks) of every view, the unmasked one first.
+        """
+        input_nodes, output_nodes, blocks = self.samplers[0].sample(g, seed_nodes)
+        views = self.sample_views(g, self.samplers[1:], output_nodes, blocks)
+        return input_nodes, output_nodes, [(input_nodes, output_nodes, blocks)] + views
+
+    def sample_views(self, g, samplers, seed_nodes, blocks):
+        """
+        Sample the masked views of a seed batch, given its unmasked sample.
+        """
+        if self.fused:
+            return filter_views(g, samplers, seed_nodes, blocks)
+        return [sampler.sample(g, seed_nodes) for sampler in samplers]
+
+
+def filter_views(g, samplers, seed_nodes, blocks):
+    """
+    Derive masked views from the unmasked sample instead of sampling them again.
+
+    Each mask is gathered once per batch for every edge of the unmasked blocks
+    (or regenerated, for counter-based masks), so the graph servers are only
+    contacted for the single unmasked sampling pass.
+    With a finite fanout the masked views are thinned from the unmasked sample
+    rather than re-sampled from the masked graph; with full neighbors they are identical.
+    """
+    eids = [block.edata[dgl.EID] for block in blocks]
+    all_eids = th.cat(eids)
+    views = []
+    for sampler in samplers:
+        keep = (sampler.masks.dense(sampler.view, "emask", all_eids) > 0).view(-1)
+        keeps = th.split(keep, [len(eid) for eid in eids])
+        views.append(filter_blocks(blocks, keeps, seed_nodes))
+    return views
+
+
+def filter_blocks(blocks, keeps, seed_nodes):
+    """
+    Rebuild sampled blocks keeping only the edges selected by ``keeps``.
+
+    The new blocks are built from the local node IDs of the sampled ones, so their size
+    follows the sample rather than the whole graph.
+
+    Parameters
+    ----------
+    blocks : List[DGLBlock]
+        Sampled blocks, input layer first.
+    keeps : List[torch.Tensor]
+        Boolean tensor per block telling which of its edges survive.
+    seed_nodes : torch.Tensor
+        Output nodes of the last block.
+
+    Returns
+    -------
+    Input nodes, output nodes and the filtered blocks, in the same layout as ``NeighborSampler.sample``.
+    """
+    # Local positions of the new destination nodes among the destination nodes of a sampled block.
+    # A block's destination nodes lead its source nodes, and its source nodes are the
+    # destination nodes of the block below, so the positions carry over between layers.
+    dst_order = th.arange(blocks[-1].num_dst_nodes())
+    filtered = []
+    for block, keep in zip(reversed(blocks), reversed(keeps)):
+        src, dst = block.edges()
+        # Nodes no longer reachable from the seeds through kept edges drop out of the lower layers.
+        is_dst = th.zeros(block.num_dst_nodes(), dtype=th.bool)
+        is_dst[dst_order] = True
+        keep = keep & is_dst[dst]
+
+        used = th.zeros(block.num_src_nodes(), dtype=th.bool)
+        used[src[keep]] = True
+        used[dst_order] = False
+        src_order = th.cat([dst_order, th.nonzero(used).view(-1)])
+
+        src_map = th.empty(block.num_src_nodes(), dtype=src.dtype)
+        src_map[src_order] = th.arange(len(src_order), dtype=src.dtype)
+        dst_map = th.empty(block.num_dst_nodes(), dtype=dst.dtype)
+        dst_map[dst_order] = th.arange(len(dst_order), dtype=dst.dtype)
+
+        new_block = dgl.create_block((src_map[src[keep]], dst_map[dst[keep]]),
+                                     num_src_nodes=len(src_order), num_dst_nodes=len(dst_order))
+        new_block.srcdata[dgl.NID] = block.srcdata[dgl.NID][src_order]
+        new_block.dstdata[dgl.NID] = block.dstdata[dgl.NID][dst_order]
+        new_block.edata[dgl.EID] = block.edata[dgl.EID][keep]
+        filtered.insert(0, new_block)
+        dst_order = src_order
+    return filtered[0].srcdata[dgl.NID], seed_nodes, filtered
+
+
+def union_views(view_blocks, view_inputs):
+    """
+    Merge the sampled blocks of several views into one disjoint-union block per layer,
+    so that a single model forward computes the predictions of every view.
+
+    Every union block keeps the destination nodes of all views first among its source nodes,
+    as sampled blocks do, and its destination nodes are ordered like the source nodes of the
+    union block above it, so the layers chain without reordering.
+
+    Parameters
+    ----------
+    view_blocks : List[List[DGLBlock]]
+        Sampled blocks of every view, input layer first, all with the same number of layers.
+    view_inputs : List[torch.Tensor]
+        Input features of every view.
+
+    Returns
+    -------
+    blocks : List[DGLBlock]
+        The union blocks, input layer first.
+    inputs : torch.Tensor
+        Input features of the union blocks.
+    num_outputs : List[int]
+        Number of output nodes of every view, in the order the outputs are stacked.
+    """
+    # Position of every view's destination nodes among the union destination nodes.
+    dst_pos = []
+    offset = 0
+    for blocks in view_blocks:
+        num_dst = blocks[-1].num_dst_nodes()
+        dst_pos.append(th.arange(offset, offset + num_dst))
+        offset += num_dst
+    num_outputs = [len(pos) for pos in dst_pos]
+
+    union = []
+    for layer in reversed(range(len(view_blocks[0]))):
+        layer_blocks = [blocks[layer] for blocks in view_blocks]
+        num_dst = offset
+        src_pos, src, dst = [], [], []
+        for block, pos in zip(layer_blocks, dst_pos):
+            num_extra = block.num_src_nodes() - block.num_dst_nodes()
+            block_src_pos = th.cat([pos, th.arange(offset, offset + num_extra)])
+            offset += num_extra
+            block_src, block_dst = block.edges()
+            src.append(block_src_pos[block_src])
+            dst.append(pos[block_dst])
+            src_pos.append(block_src_pos)
+        union.insert(0, dgl.create_block((th.cat(src), th.cat(dst)), num_src_nodes=offset, num_dst_nodes=num_dst))
+        dst_pos = src_pos
+
+    inputs = view_inputs[0].new_empty((offset,) + view_inputs[0].shape[1:])
+    for pos, view_input in zip(dst_pos, view_inputs):
+        inputs[pos] = view_input
+    return union, inputs, num_outputs
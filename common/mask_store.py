@@ -0,0 +1,219 @@
+import dgl
+import torch as th
+import torch.distributed as dist
+
+from common.calc import uniform_hash
+from common import metrics
+
+MASK_VIEWS = ("org", "prev", "cur")
+
+MASK_KINDS = ("emask", "nmask")
+
+MASK_DTYPES = {"float32": th.float32, "bool": th.bool}
+
+
+def init(shape, dtype):
+    return th.ones(size=shape, dtype=dtype)
+
+
+class MaskStore:
+    """
+    Versioned registry of the edge and node masks of the org/prev/cur graph views
+
+    The store holds ``num_buffers`` mask buffers per kind, ``emask_<i>`` in ``g.edata`` and
+    ``nmask_<i>`` in ``g.ndata``, and a pointer from every graph view to the buffer holding it.
+    Promoting the accepted augmentation to "prev" swaps pointers instead of copying masks.
+    Samplers and ``MHMasking`` resolve buffer names through ``name`` every time they use one.
+    A boolean store takes a quarter of the float32 one; readers that need numbers convert
+    the gathered rows with ``dense``.
+
+    With a ``seed``, masks are counter-based: a buffer's state is a seed and the edge and node
+    drop ratios of every partition, and the keep decision of any ID is regenerated from it on demand.
+    The DistTensors are then only needed by server-side sampling; without them (``stored=False``)
+    the masks take no storage at all.
+
+    Parameters
+    ----------
+    g : DistGraph
+        The distributed graph.
+    dtype : torch.dtype
+        Storage type of the masks, ``torch.float32`` or ``torch.bool``.
+    num_buffers : int
+        Number of mask buffers per kind, at least one per graph view.
+    seed : int
+        Base seed of counter-based masks, the same on all trainers. ``None`` for stored masks.
+    stored : bool
+        Keep the masks in DistTensors. Counter-based masks are written there for the owned IDs.
+    """
+
+    def __init__(self, g, dtype=th.float32, num_buffers=len(MASK_VIEWS), seed=None, stored=True):
+        assert num_buffers >= len(MASK_VIEWS)
+        assert stored or seed is not None
+        self.g = g
+        self.dtype = dtype
+        self.seed = seed
+        self.stored = stored
+        self.pointers = {view: i for i, view in enumerate(MASK_VIEWS)}
+        # Counter-based state of every buffer, None while it keeps everything.
+        self.states = [None] * num_buffers
+        # Number of times every buffer was rewritten, to tell whether data derived from it is stale.
+        self.versions = [0] * num_buffers
+        self.num_states = 0
+
+        if stored:
+            for i in range(num_buffers):
+                g.edata[f"emask_{i}"] = dgl.distributed.DistTensor(
+                    (g.num_edges(), 1), dtype, name=f"emask_{i}", init_func=init)
+                g.ndata[f"nmask_{i}"] = dgl.distributed.DistTensor(
+                    (g.num_nodes(), 1), dtype, name=f"nmask_{i}", init_func=init)
+
+    @property
+    def counter_based(self):
+        return self.seed is not None
+
+    def name(self, view, kind):
+        """
+        Name of the buffer currently holding the ``kind`` ("emask" or "nmask") mask of a graph view.
+        """
+        return f"{kind}_{self.pointers[view]}"
+
+    def __getitem__(self, key):
+        """
+        DistTensor of a (view, kind) mask.
+        """
+        view, kind = key
+        data = self.g.edata if kind == "emask" else self.g.ndata
+        return data[self.name(view, kind)]
+
+    def dense(self, view, kind, ids):
+        """
+        Gather mask rows and convert them to float32 for computation.
+        """
+        if self.counter_based:
+            return self.keep(view, kind, ids).float().view(-1, 1)
+        return self[view, kind][ids].float()
+
+    def keep(self, view, kind, ids):
+        """
+        Regenerate the keep decision of counter-based masks for the given IDs.
+        """
+        return self.state_keep(self.states[self.pointers[view]], kind, ids)
+
+    def state_keep(self, state, kind, ids):
+        """
+        Keep decision of the given IDs under a counter-based state, which need not be set on any view.
+        """
+        if state is None:
+            return th.ones(len(ids), dtype=th.bool)
+        seed, drop_e, drop_v = state
+        pb = self.g.get_partition_book()
+        if kind == "emask":
+            drop = drop_e[pb.eid2partid(ids)]
+        else:
+            drop = drop_v[pb.nid2partid(ids)]
+        return uniform_hash(ids, seed, MASK_KINDS.index(kind)) >= drop
+
+    def next_seed(self):
+        """
+        Seed of the next counter-based state. All trainers draw the same sequence.
+        """
+        self.num_states += 1
+        return (self.seed << 32) + self.num_states
+
+    def set_state(self, view, state):
+        """
+        Set the counter-based masks of a graph view.
+
+        Stored masks are written shard by shard, so all trainers have to call it together:
+        it returns once every trainer has written its shard, before anyone samples the view.
+
+        Parameters
+        ----------
+        view : str
+            Graph view to set, e.g. "cur".
+        state : tuple
+            Seed from ``next_seed``, and the edge and node drop ratio of every partition.
+        """
+        self.states[self.pointers[view]] = state
+        self.touch(view)
+        if self.stored:
+            for kind in MASK_KINDS:
+                ids = self.owned(kind)
+                self[view, kind][ids] = self.keep(view, kind, ids).view(-1, 1).to(self.dtype)
+            # Multi-hop samples reach edges owned by other trainers.
+            with metrics.timer("mh/mask_barrier"):
+                dist.barrier()
+
+    def touch(self, view):
+        """
+        Record that the masks of a graph view were rewritten.
+        """
+        self.versions[self.pointers[view]] += 1
+
+    def version(self, view):
+        """
+        Buffer and version of the masks of a graph view. Equal versions hold the same masks.
+        """
+        ptr = self.pointers[view]
+        return ptr, self.versions[ptr]
+
+    def local_count(self, view, kind):
+        """
+        Number of kept edges or nodes in the local partition.
+        """
+        if not self.counter_based:
+            return self[view, kind].local_partition.sum()
+        pb = self.g.get_partition_book()
+        ids = pb.partid2eids(pb.partid) if kind == "emask" else pb.partid2nids(pb.partid)
+        return self.keep(view, kind, ids).sum()
+
+    def owned(self, kind):
+        """
+        IDs of this trainer's share of the local partition.
+        """
+        pb = self.g.get_partition_book()
+        ids = pb.partid2eids(pb.partid) if kind == "emask" else pb.partid2nids(pb.partid)
+        # Trainers on the same machine share its partition, so each takes a slice of it.
+        num_trainers = dist.get_world_size() // pb.num_partitions()
+        return th.tensor_split(ids, num_trainers)[self.g.rank() % num_trainers]
+
+    def promote(self):
+        """
+        Make the accepted "cur" masks the new "prev" ones.
+
+        The old "prev" buffer is handed to "cur", which the next proposal overwrites.
+        """
+        self.pointers["prev"], self.pointers["cur"] = self.pointers["cur"], self.pointers["prev"]
+
+    def state_dict(self):
+        """
+        Pointers, counter-based states and this trainer's shards of the stored prev/cur masks.
+
+        The shards are copies of the owned mask rows, by buffer name. Counter-based masks
+        are regenerated from their states and need no shards.
+        """
+        shards = {}
+        if self.stored and not self.counter_based:
+            for view in ("prev", "cur"):
+                for kind in MASK_KINDS:
+                    shards[self.name(view, kind)] = self[view, kind][self.owned(kind)]
+        return {"pointers": dict(self.pointers), "states": list(self.states), "num_states": self.num_states,
+                "versions": list(self.versions), "shards": shards}
+
+    def load_state_dict(self, state):
+        """
+        Restore the masks saved by ``state_dict`` on a trainer with the same rank and world size.
+        """
+        self.pointers = dict(state["pointers"])
+        self.states = list(state["states"])
+        self.num_states = state["num_states"]
+        self.versions = list(state["versions"])
+        for name, rows in state["shards"].items():
+            kind = name.split("_")[0]
+            data = self.g.edata if kind == "emask" else self.g.ndata
+            data[name][self.owned(kind)] = rows.view(-1, 1).to(self.dtype)
+        if self.stored and self.counter_based:
+            for view in ("prev", "cur"):
+                for kind in MASK_KINDS:
+                    ids = self.owned(kind)
+                    self[view, kind][ids] = self.keep(view, kind, ids).view(-1, 1).to(self.dtype)
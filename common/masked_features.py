@@ -0,0 +1,34 @@
+class MaskedFeatures:
+    """
+    Node features of a graph view, zeroing masked nodes when rows are gathered
+
+    Every view reads the single feature DistTensor, so no per-view copy of the
+    feature matrix is allocated or sent over the network.
+
+    Parameters
+    ----------
+    features : DistTensor
+        Feature data of all the nodes.
+    masks : MaskStore
+        Edge and node masks of the graph views.
+    view : str
+        Graph view whose node mask is applied, e.g. "prev" or "cur".
+    """
+
+    def __init__(self, features, masks, view):
+        self.features = features
+        self.masks = masks
+        self.view = view
+
+    def __getitem__(self, ids):
+        return self.apply(self.features[ids], ids)
+
+    def apply(self, rows, ids):
+        """
+        Mask feature rows of the given IDs that were gathered from ``features`` elsewhere.
+        """
+        return rows * self.masks.dense(self.view, "nmask", ids)
+
+    @property
+    def shape(self):
+        return self.features.shape
@@ -0,0 +1,220 @@
+import contextlib
+import json
+import math
+import os
+import queue
+import threading
+import time
+
+import torch.distributed as dist
+
+from common import trace
+
+
+class Metrics:
+    """
+    Named counters, timers and histograms of one rank, written as JSONL by a background thread
+
+    Every ``flush`` appends one record with the values collected since the last flush to
+    ``<directory>/metrics_rank<rank>.jsonl``, and rank 0 also writes the values aggregated over
+    all ranks (sum, min and max per name). Updates only touch in-memory dicts, so they can be
+    made from any thread and never wait for the file or another rank.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the JSONL files.
+    rank : int
+        Rank of this trainer.
+    """
+
+    def __init__(self, directory, rank):
+        os.makedirs(directory, exist_ok=True)
+        self.rank = rank
+        self._lock = threading.Lock()
+        self._reset()
+
+        self._records = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._write, args=(os.path.join(directory, f"metrics_rank{rank}.jsonl"),), daemon=True)
+        self._thread.start()
+
+    def _reset(self):
+        self.counters = {}
+        # name -> [count, total seconds, max seconds]
+        self.timers = {}
+        # name -> [count, sum, min, max, {power-of-two bucket: count}]
+        self.histograms = {}
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - tic)
+
+    def add_time(self, name, seconds):
+        """
+        Record a duration measured elsewhere under a timer.
+        """
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def observe(self, name, value):
+        value = float(value)
+        if not math.isfinite(value):
+            # Counted on their own, since they have no bucket and would swamp the sum, min and max.
+            self.count(f"{name}/non_finite")
+            return
+        bucket = math.floor(math.log2(abs(value))) if value != 0 else None
+        with self._lock:
+            hist = self.histograms.setdefault(name, [0, 0.0, math.inf, -math.inf, {}])
+            hist[0] += 1
+            hist[1] += value
+            hist[2] = min(hist[2], value)
+            hist[3] = max(hist[3], value)
+            hist[4][bucket] = hist[4].get(bucket, 0) + 1
+
+    def flush(self, epoch):
+        """
+        Write the values collected since the last flush. All ranks have to call it together.
+        """
+        with self._lock:
+            record = {"counters": self.counters,
+                      "timers": {name: {"count": c, "total": t, "max": m} for name, (c, t, m) in self.timers.items()},
+                      "histograms": {name: {"count": c, "sum": s, "min": lo, "max": hi,
+                                            "buckets": {str(b): n for b, n in buckets.items()}}
+                                     for name, (c, s, lo, hi, buckets) in self.histograms.items()}}
+            self._reset()
+        self._records.put({"time": time.time(), "rank": self.rank, "epoch": epoch, **record})
+
+        gathered = [None] * dist.get_world_size()
+        dist.all_gather_object(gathered, record)
+        if self.rank == 0:
+            self._records.put({"time": time.time(), "rank": "all", "epoch": epoch, **_aggregate(gathered)})
+
+    def close(self):
+        self._records.put(None)
+        self._thread.join()
+
+    def _write(self, path):
+        with open(path, "a") as f:
+            while True:
+                record = self._records.get()
+                if record is None:
+                    return
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+
+
+class NullMetrics:
+    """
+    Metrics that record nothing, used when metrics are disabled.
+    """
+
+    def count(self, name, value=1):
+        pass
+
+    def timer(self, name):
+        return _NULL_CONTEXT
+
+    def add_time(self, name, seconds):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def flush(self, epoch):
+        pass
+
+    def close(self):
+        pass
+
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+_metrics = NullMetrics()
+
+
+def configure(directory, rank):
+    """
+    Start collecting metrics into ``directory``. ``None`` keeps them disabled.
+    """
+    global _metrics
+    if directory is not None:
+        _metrics = Metrics(directory, rank)
+    return _metrics
+
+
+def count(name, value=1):
+    _metrics.count(name, value)
+
+
+def timer(name):
+    # Timed phases are also spans of the trace, when tracing is on.
+    if trace.enabled():
+        return _traced_timer(name)
+    return _metrics.timer(name)
+
+
+@contextlib.contextmanager
+def _traced_timer(name):
+    with trace.span(name), _metrics.timer(name):
+        yield
+
+
+@contextlib.contextmanager
+def timed_exit(name, context):
+    """
+    Enter ``context`` and time only its exit, e.g. the wait of ``DistributedDataParallel.join``
+    for the ranks that still have batches.
+    """
+    with context:
+        try:
+            yield
+        finally:
+            tic = time.perf_counter()
+    add_time(name, time.perf_counter() - tic)
+
+
+def add_time(name, seconds):
+    """
+    Record a duration that just ended, measured elsewhere.
+    """
+    _metrics.add_time(name, seconds)
+    trace.complete(name, time.perf_counter() - seconds, seconds)
+
+
+def observe(name, value):
+    _metrics.observe(name, value)
+
+
+def flush(epoch):
+    _metrics.flush(epoch)
+
+
+def close():
+    _metrics.close()
+
+
+def _aggregate(records):
+    """
+    Sum, min and max over ranks of every counter, timer total and histogram sum.
+    """
+    values = {}
+    for record in records:
+        for name, value in record["counters"].items():
+            values.setdefault(f"counters/{name}", []).append(value)
+        for name, timer in record["timers"].items():
+            values.setdefault(f"timers/{name}", []).append(timer["total"])
+        for name, hist in record["histograms"].items():
+            values.setdefault(f"histograms/{name}", []).append(hist["sum"])
+    return {name: {"sum": sum(v), "min": min(v), "max": max(v), "ranks": len(v)} for name, v in values.items()}
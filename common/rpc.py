@@ -0,0 +1,24 @@
+import threading
+
+# The DGL RPC client is not thread-safe: threads that share it (e.g. the training loop and a
+# background augmentation worker) take this lock around every graph server request.
+# Graph server barriers and DistTensor creation go through the same client, so evaluation holds
+# the lock while DistSAGE.inference waits on them for the other trainers. That only stays free
+# of deadlocks because no holder waits on its peers through any other channel: never hold the
+# lock across a torch.distributed collective, e.g. one on the augmentation group.
+RPC_LOCK = threading.RLock()
+
+_END = object()
+
+
+def locked(iterable):
+    """
+    Iterate with ``RPC_LOCK`` held while each item is produced, e.g. while a loader samples a batch.
+    """
+    iterator = iter(iterable)
+    while True:
+        with RPC_LOCK:
+            item = next(iterator, _END)
+        if item is _END:
+            return
+        yield item
@@ -0,0 +1,18 @@
+import torch as th
+
+
+class SeedIndex:
+    """
+    Map global node IDs of a fixed seed set (e.g. ``train_nid``) to their positions in it.
+
+    Parameters
+    ----------
+    nids : torch.Tensor
+        The seed node IDs. Positions refer to this order.
+    """
+
+    def __init__(self, nids):
+        self.sorted_nids, self.order = th.sort(nids)
+
+    def __call__(self, ids):
+        return self.order[th.searchsorted(self.sorted_nids, ids)]
@@ -0,0 +1,52 @@
+import dgl
+import numpy as np
+import scipy.sparse as sp
+import torch as th
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+from common.seed_index import SeedIndex
+
+
+def locality_order(g, nids):
+    """
+    Order seed node IDs so that consecutive seeds are close in the local partition.
+
+    The local partition is ordered once with reverse Cuthill-McKee, a BFS ordering that keeps
+    neighbors together, so a batch of consecutive seeds shares most of its multi-hop
+    neighborhood. Seeds outside the local partition keep their order at the end.
+
+    Parameters
+    ----------
+    g : DistGraph
+        The distributed graph.
+    nids : torch.Tensor
+        Seed node IDs.
+
+    Returns
+    -------
+    torch.Tensor
+        The seed node IDs in locality order.
+    """
+    local_g = g.local_partition
+    num_nodes = local_g.num_nodes()
+    src, dst = local_g.edges()
+    adj = sp.csr_matrix((np.ones(len(src), dtype=np.int8), (src.numpy(), dst.numpy())),
+                        shape=(num_nodes, num_nodes))
+    rank = th.empty(num_nodes, dtype=th.int64)
+    rank[th.from_numpy(reverse_cuthill_mckee(adj, symmetric_mode=False).astype(np.int64))] = \
+        th.arange(num_nodes)
+
+    local_nids = local_g.ndata[dgl.NID]
+    is_local = th.isin(nids, local_nids)
+    keys = th.full((len(nids),), num_nodes, dtype=th.int64)
+    keys[is_local] = rank[SeedIndex(local_nids)(nids[is_local])]
+    return nids[th.sort(keys, stable=True).indices]
+
+
+def cluster_permutation(num_seeds, cluster_size):
+    """
+    Random order of ``num_seeds`` positions that shuffles whole clusters of ``cluster_size``
+    consecutive positions, keeping every cluster together.
+    """
+    clusters = th.arange(num_seeds).split(cluster_size)
+    return th.cat([clusters[i] for i in th.randperm(len(clusters)).tolist()])
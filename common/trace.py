@@ -0,0 +1,121 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+import torch as th
+import torch.distributed as dist
+
+
+class Tracer:
+    """
+    Chrome/Perfetto trace of one rank
+
+    Spans are kept in memory and appended to ``<directory>/trace_rank<rank>.json`` by every
+    ``flush``, one track per thread. The file uses the JSON array format, whose closing bracket
+    is optional, so the trace of a crashed or killed run still opens up to its last flush.
+    Timestamps are shifted to rank 0's clock, measured when all ranks leave a barrier, so
+    traces of different ranks line up when merged with ``merge_traces.py``.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the trace files.
+    rank : int
+        Rank of this trainer.
+    """
+
+    def __init__(self, directory, rank):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"trace_rank{rank}.json")
+        self.rank = rank
+        self.events = []
+        self._lock = threading.Lock()
+        metadata = {"name": "process_name", "ph": "M", "pid": rank, "args": {"name": f"rank {rank}"}}
+        self._file = open(self.path, "w")
+        self._file.write("[" + json.dumps(metadata))
+        self._file.flush()
+
+        dist.barrier()
+        self._base_perf = time.perf_counter()
+        base_wall = th.tensor([time.time()], dtype=th.float64)
+        walls = [th.zeros_like(base_wall) for _ in range(dist.get_world_size())]
+        dist.all_gather(walls, base_wall)
+        # Wall clock of rank 0 when this rank left the barrier.
+        self._base_time = float(walls[0])
+
+    def timestamp(self, perf):
+        """
+        Trace timestamp in microseconds of a ``time.perf_counter`` reading.
+        """
+        return (self._base_time + perf - self._base_perf) * 1e6
+
+    def complete(self, name, start, seconds):
+        """
+        Add a span that started at ``start`` (a ``time.perf_counter`` reading) and took ``seconds``.
+        """
+        event = {"name": name, "cat": name.split("/")[0], "ph": "X", "ts": self.timestamp(start),
+                 "dur": seconds * 1e6, "pid": self.rank, "tid": threading.current_thread().name}
+        with self._lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.complete(name, tic, time.perf_counter() - tic)
+
+    def flush(self):
+        """
+        Append the spans added since the last flush to the trace file.
+        """
+        with self._lock:
+            events, self.events = self.events, []
+        self._file.write("".join(",\n" + json.dumps(event) for event in events))
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.write("]\n")
+        self._file.close()
+
+
+_tracer = None
+
+
+def configure(directory, rank):
+    """
+    Start tracing into ``directory``. ``None`` keeps tracing disabled. All ranks have to call it.
+    """
+    global _tracer
+    if directory is not None:
+        _tracer = Tracer(directory, rank)
+    return _tracer
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(name):
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(name)
+
+
+def complete(name, start, seconds):
+    if _tracer is not None:
+        _tracer.complete(name, start, seconds)
+
+
+def flush():
+    if _tracer is not None:
+        _tracer.flush()
+
+
+def close():
+    if _tracer is not None:
+        _tracer.close()
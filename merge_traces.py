@@ -0,0 +1,38 @@
+import argparse
+import glob
+import json
+import os
+
+
+def merge_traces(trace_dir, output):
+    """
+    Merge the per-rank traces written with --trace_dir into one multi-rank timeline.
+
+    Parameters
+    ----------
+    trace_dir : str
+        Directory holding the ``trace_rank<rank>.json`` files, complete or cut short by a crash.
+    output : str
+        Path of the merged trace, to open in chrome://tracing or Perfetto.
+    """
+    events = []
+    paths = sorted(glob.glob(os.path.join(trace_dir, "trace_rank*.json")))
+    for path in paths:
+        with open(path) as f:
+            text = f.read().rstrip().rstrip(",")
+        # The trace of a run that did not finish lacks the closing bracket.
+        events += json.loads(text if text.endswith("]") else text + "]")
+    with open(output, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    print(f"Merged {len(paths)} traces, {len(events)} events, into {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge per-rank Chrome traces")
+    parser.add_argument("--trace_dir", type=str, required=True,
+        help="Directory of the per-rank traces written by node_classification.py --trace_dir")
+    parser.add_argument("--output", type=str, default=None,
+        help="Path of the merged trace. Defaults to <trace_dir>/trace.json")
+    args = parser.parse_args()
+
+    merge_traces(args.trace_dir, args.output or os.path.join(args.trace_dir, "trace.json"))
@@ -1,18 +1,26 @@
+import copy
+import math
+import queue
 import random
+import threading
 
 import dgl
 import torch as th
 import torch.distributed as dist
 
 import numpy as np
-from scipy.stats import truncnorm
+from scipy.stats import truncnorm, t as student_t
 from scipy.special import betaln
 
 from augmentation.masking import MHMasking
-from training.loss import HLoss
+from augmentation.ego_graph import EgoGraphCounter
+from training.loss import normalized_entropy
 from training.model import SimpleAGG
-from common.load_batch import AugDataLoader
+from common.load_batch import AugDataLoader, MaskedNeighborSampler
+from common.seed_index import SeedIndex
 from common.calc import log_normal
+from common.rpc import RPC_LOCK, locked
+from common import metrics
 
 
 @th.no_grad()
@@ -21,136 +29,498 @@ def aggregate(block, agg_model, x):
     return s_vec
 
 
-@th.no_grad()
-def mh_aug(args, g, model, train_nid, device):
-    org_num_edges = g.local_partition.num_edges()
-    org_num_nodes = g.local_partition.num_nodes()
-    prev_num_edges = g.edata["prev_emask"].local_partition.sum()
-    prev_num_nodes = g.ndata["prev_nmask"].local_partition.sum()
-
-    delta_g_e = 1 - prev_num_edges / org_num_edges
-    a, b = ((0 - delta_g_e) / args.sigma_delta_e), ((1 - delta_g_e) / args.sigma_delta_e)
-    delta_g_e_aug = th.tensor(truncnorm.rvs(a, b, loc=delta_g_e, scale=args.sigma_delta_e), dtype=th.float64)
-
-    delta_g_v = 1 - prev_num_nodes / org_num_nodes
-    a, b = ((0 - delta_g_v) / args.sigma_delta_v), ((1 - delta_g_v) / args.sigma_delta_v)
-    delta_g_v_aug = th.tensor(truncnorm.rvs(a, b, loc=delta_g_v, scale=args.sigma_delta_v), dtype=th.float64)
-
-    MHMasking(g, delta_g_e_aug, delta_g_v_aug, device)
-
-    agg_model = SimpleAGG(num_hop=2)
-    agg_model.to(device)
-
-    h_loss = HLoss()
-
-    model.eval()
-
-    ones = g.ndata["ones"]
-
-    num_seeds = 0
-    num_inputs = 0
-    batch_cnt = 0
-    acceptance_sum = 0
-
-    # Declare Samplers
-    fanout = [-1]
-    samplers = [dgl.dataloading.NeighborSampler(fanout, mask=None),
-                dgl.dataloading.NeighborSampler(fanout, mask="prev_emask"),
-                dgl.dataloading.NeighborSampler(fanout, mask="cur_emask")]
-
-    # Declare DataLoader
-    dataloader = AugDataLoader(g, samplers, train_nid,
-                               batch_size=args.batch_size, shuffle=False, drop_last=False, device="cpu")
-
-    for step, src_and_blocks in enumerate(dataloader):
-        batch_cnt += 1
-
-        org = src_and_blocks["org"]
-        org_input_nodes = org[0]
-        org_blocks = org[2]
-
-        prev = src_and_blocks["prev"]
-        prev_input_nodes = prev[0]
-        prev_blocks = prev[2]
-
-        cur = src_and_blocks["cur"]
-        cur_input_nodes = cur[0]
-        cur_blocks = cur[2]
-
-        # Slice feature and label.
-        batch_inputs = g.ndata["features"][org_input_nodes]
-        num_seeds += len(org_blocks[-1].dstdata[dgl.NID])
-        num_inputs += len(org_blocks[0].srcdata[dgl.NID])
-
-        org_ones = ones[org_input_nodes]
-        prev_ones = ones[prev_input_nodes]
-        cur_ones = ones[cur_input_nodes]
-
-        # Move to target device.
-        org_blocks = [block.to(device) for block in org_blocks]
-        prev_blocks = [block.to(device) for block in prev_blocks]
-        cur_blocks = [block.to(device) for block in cur_blocks]
-
-        batch_inputs = batch_inputs.to(device)
-
-        org_ones = org_ones.to(device)
-        prev_ones = prev_ones.to(device)
-        cur_ones = cur_ones.to(device)
-
-        # Get prediction to calculate ent.
-        batch_pred = model(org_blocks, batch_inputs)
-
-        max_ent = h_loss(th.full((1, batch_pred.shape[1]), 1 / batch_pred.shape[1])).item()
-        ent = h_loss(batch_pred.detach(), True) / max_ent
-
-        batch_org_ego = aggregate(org_blocks, agg_model, org_ones)
-
-        delta_g_e_ = 1 - (aggregate(prev_blocks, agg_model, prev_ones) / batch_org_ego).squeeze(1)
-        delta_g_aug_e_ = 1 - (aggregate(cur_blocks, agg_model, cur_ones) / batch_org_ego).squeeze(1)
-        delta_g_v_ = 1 - (aggregate(prev_blocks, agg_model, prev_ones) / batch_org_ego).squeeze(1)
-        delta_g_aug_v_ = 1 - (aggregate(cur_blocks, agg_model, cur_ones) / batch_org_ego).squeeze(1)
-
-        p = (args.lam1_e * log_normal(delta_g_e_, args.mu_e, args.a_e * ent + args.b_e) +
-             args.lam1_v * log_normal(delta_g_v_, args.mu_v, args.a_v * ent + args.b_v))
-
-        p_aug = (args.lam1_e * log_normal(delta_g_aug_e_, args.mu_e, args.a_e * ent + args.b_e) +
-                 args.lam1_v * log_normal(delta_g_aug_v_, args.mu_v, args.a_v * ent + args.b_v))
-
-        a_e, b_e = (0 - delta_g_e_aug) / args.sigma_delta_e, (1 - delta_g_e_aug) / args.sigma_delta_e
-        a_v, b_v = (0 - delta_g_v_aug) / args.sigma_delta_v, (1 - delta_g_v_aug) / args.sigma_delta_v
-        q = (truncnorm.logpdf(delta_g_e, a_e, b_e, loc=delta_g_e_aug, scale=args.sigma_delta_e) +
-             args.lam2_e * betaln(org_num_edges - org_num_edges * delta_g_e + 1, org_num_edges * delta_g_e + 1) +
-             truncnorm.logpdf(delta_g_v, a_v, b_v, loc=delta_g_v_aug, scale=args.sigma_delta_v) +
-             args.lam2_v * betaln(org_num_nodes - org_num_nodes * delta_g_v + 1, org_num_nodes * delta_g_v + 1))
-
-        a_e, b_e = (0 - delta_g_e) / args.sigma_delta_e, (1 - delta_g_e) / args.sigma_delta_e
-        a_v, b_v = (0 - delta_g_v) / args.sigma_delta_v, (1 - delta_g_v) / args.sigma_delta_v
-        q_aug = (truncnorm.logpdf(delta_g_e_aug, a_e, b_e, loc=delta_g_e, scale=args.sigma_delta_e) +
-                 args.lam2_e * betaln(org_num_edges - org_num_edges * delta_g_e_aug + 1, org_num_edges * delta_g_e_aug + 1) +
-                 truncnorm.logpdf(delta_g_v_aug, a_v, b_v, loc=delta_g_v, scale=args.sigma_delta_v) +
-                 args.lam2_v * betaln(org_num_nodes - org_num_nodes * delta_g_v_aug + 1, org_num_nodes * delta_g_v_aug + 1))
-
-        acceptance_sum += ((th.sum(p_aug) - th.sum(p)) - (q_aug - q))
-
-    size = dist.get_world_size()
-
-    rv = th.tensor([float(np.log(random.random()))])
-    acceptance = th.tensor([float(acceptance_sum / batch_cnt)])
-
-    dist.all_reduce(rv, op=dist.ReduceOp.SUM)
-    dist.all_reduce(acceptance, op=dist.ReduceOp.SUM)
-
-    rv = float(rv.item() / size)
-    acceptance = float(acceptance.item() / size)
-
-    is_accepted = (rv < acceptance)
-
-    print(f"{g.rank()}'s mh-aug: rv = {rv:.4f}, acceptance = {acceptance:.4f}, {is_accepted}")
-
-    if is_accepted:
-        if delta_g_e + delta_g_v < delta_g_e_aug + delta_g_v_aug:
-            return g, True
+class MHAug:
+    """
+    Metropolis-Hastings Augmentation
+
+    Keeps the samplers, loaders and ego-graph counter alive across proposals,
+    so that a retried proposal only pays for the masking and the evaluation.
+
+    Parameters
+    ----------
+    args : argparse.Args
+        Arguments for augmentation.
+    g : DistGraph
+        The distributed graph.
+    masks : MaskStore
+        Edge and node masks of the graph views.
+    train_nid : torch.Tensor
+        Training node IDs of this trainer.
+    device : torch.Device
+        Target device for the model forward.
+    group : ProcessGroup
+        Process group of the augmentation collectives. ``None`` for the default group.
+    ent_cache : EntropyCache
+        Prediction entropy of the seeds kept by the training loop. ``None`` to run the model.
+    features : DistTensor or FeatureCache
+        Feature data of all the nodes. ``None`` reads ``g.ndata["features"]``.
+    """
+
+    def __init__(self, args, g, masks, train_nid, device, group=None, ent_cache=None, features=None):
+        self.args = args
+        self.g = g
+        self.masks = masks
+        self.train_nid = train_nid
+        self.device = device
+        self.group = group
+        self.ent_cache = ent_cache
+        self.features = features if features is not None else g.ndata["features"]
+        # Counter-based proposals can be evaluated without writing their masks.
+        self.by_state = args.masking == "hash" and args.ego_engine == "sparse"
+
+        if args.num_proposals > 1 and not self.by_state:
+            raise RuntimeError("Batched proposals need --ego_engine sparse and --masking hash")
+
+        self.seed_index = SeedIndex(train_nid)
+
+        # Depth of the ego-graphs whose change ratios enter the target, the same for both engines
+        # and the column read from the --org_ego_path sidecar.
+        num_hop = 2
+        self.num_hop = num_hop
+        # SimpleAGG aggregates one hop per full-neighbor block. The entropy forward needs one
+        # block per model layer, to predict the classes the training loop caches entropies of.
+        fanout = [-1] * max(num_hop, args.num_layers)
+        # The sequential acceptance test needs the batches it draws to be a random sample.
+        shuffle = args.mh_tolerance is not None
+        self.shuffle = shuffle
+        if args.ego_engine == "sparse":
+            self.ego_counter = EgoGraphCounter(g, train_nid, num_hop=num_hop, group=group)
+            self.ego_counter.reserve(1 + args.num_proposals)
+            self.dataloader = dgl.dataloading.DistNodeDataLoader(
+                g, train_nid, dgl.dataloading.NeighborSampler(fanout, mask=None),
+                batch_size=args.batch_size, shuffle=shuffle, drop_last=False, device="cpu")
+        else:
+            self.agg_model = SimpleAGG(num_hop=num_hop)
+            self.agg_model.to(device)
+            samplers = [dgl.dataloading.NeighborSampler(fanout, mask=None),
+                        MaskedNeighborSampler(fanout, masks, "prev"),
+                        MaskedNeighborSampler(fanout, masks, "cur")]
+            self.dataloader = AugDataLoader(g, samplers, train_nid,
+                                            batch_size=args.batch_size, shuffle=shuffle, drop_last=False,
+                                            device="cpu", fused=args.fused_sampling)
+
+        # Ego-graph sizes on the original graph never change, so they are counted once per seed.
+        if args.org_ego_path is not None:
+            self.org_ego = th.load(args.org_ego_path)[train_nid, num_hop - 1].to(device)
+        elif args.ego_engine == "sparse":
+            self.org_ego = self.ego_counter(self.ego_counter.edge_weights()).view(-1).to(device)
+        else:
+            self.org_ego = self._agg_org_ego([-1] * num_hop)
+
+    def __call__(self, model):
+        with metrics.timer("mh/propose"):
+            kl_loss_opt, state = self.propose(model)
+        if state is not None:
+            self.masks.set_state("cur", state)
+        return self.g, kl_loss_opt
+
+    @th.no_grad()
+    def propose(self, model, base="prev"):
+        """
+        Propose and evaluate one augmentation that moves from the masks of the ``base`` view.
+
+        Counter-based proposals evaluated with the sparse engine are not written anywhere:
+        the accepted state is returned for the caller to set. Other proposals are drawn
+        into the "cur" masks.
+
+        Returns
+        -------
+        kl_loss_opt : bool or None
+            Whether the accepted proposal masks more than the base, ``None`` if rejected.
+        state : tuple or None
+            Counter-based state of the accepted proposal, if it still has to be set.
+        """
+        args = self.args
+        g = self.g
+        num_proposals = args.num_proposals
+
+        org_num_edges = g.local_partition.num_edges()
+        org_num_nodes = g.local_partition.num_nodes()
+        prev_num_edges = self.masks.local_count(base, "emask")
+        prev_num_nodes = self.masks.local_count(base, "nmask")
+
+        delta_g_e = float(1 - prev_num_edges / org_num_edges)
+        a, b = ((0 - delta_g_e) / args.sigma_delta_e), ((1 - delta_g_e) / args.sigma_delta_e)
+        delta_g_e_aug = truncnorm.rvs(a, b, loc=delta_g_e, scale=args.sigma_delta_e, size=num_proposals)
+
+        delta_g_v = float(1 - prev_num_nodes / org_num_nodes)
+        a, b = ((0 - delta_g_v) / args.sigma_delta_v), ((1 - delta_g_v) / args.sigma_delta_v)
+        delta_g_v_aug = truncnorm.rvs(a, b, loc=delta_g_v, scale=args.sigma_delta_v, size=num_proposals)
+
+        with metrics.timer("mh/masking"):
+            if self.by_state:
+                # Candidates are evaluated from their counter-based states; only the accepted one is set.
+                states = MHMasking(g, self.masks, th.from_numpy(delta_g_e_aug), th.from_numpy(delta_g_v_aug),
+                                   self.device, mode=args.masking, group=self.group).counter_states()
+            else:
+                MHMasking(g, self.masks, delta_g_e_aug[0], delta_g_v_aug[0], self.device,
+                          mode=args.masking, group=self.group)()
+                states = None
+
+        model.eval()
+
+        # The proposal terms do not depend on the seed batch.
+        q = th.from_numpy(log_proposal(args, delta_g_e, delta_g_v, delta_g_e_aug, delta_g_v_aug,
+                                       org_num_edges, org_num_nodes))
+        q_aug = th.from_numpy(log_proposal(args, delta_g_e_aug, delta_g_v_aug, delta_g_e, delta_g_v,
+                                           org_num_edges, org_num_nodes))
+
+        if args.ego_engine == "sparse":
+            batches = self._sparse_batches(model, base, states)
+        else:
+            batches = self._agg_batches(model)
+        log_ratios = self._log_ratios(batches, q, q_aug)
+
+        with metrics.timer("mh/evaluate"):
+            if args.mh_tolerance is None:
+                batch_cnt = 0
+                acceptance_sum = 0
+                for log_ratio in log_ratios:
+                    batch_cnt += 1
+                    acceptance_sum += log_ratio
+
+                size = dist.get_world_size(self.group)
+
+                # One collective decides every candidate.
+                rv = th.tensor([float(np.log(random.random())) for _ in range(num_proposals)], dtype=th.float64)
+                decision = th.cat([rv, acceptance_sum / batch_cnt])
+                with metrics.timer("mh/collective"):
+                    dist.all_reduce(decision, op=dist.ReduceOp.SUM, group=self.group)
+                rv, acceptance = (decision / size).split(num_proposals)
+            else:
+                rv, acceptance = self._sequential_test(log_ratios, num_proposals)
+
+        is_accepted = rv < acceptance
+        metrics.count("mh/proposals", num_proposals)
+        metrics.count("mh/accepted", int(is_accepted.any()))
+        for k in range(num_proposals):
+            metrics.observe("mh/acceptance", acceptance[k])
+
+        # Per-proposal details go to the metrics sink; printing them is opt-in.
+        if args.mh_verbose:
+            for k in range(num_proposals):
+                print(f"{g.rank()}'s mh-aug: rv = {rv[k]:.4f}, acceptance = {acceptance[k]:.4f}, "
+                      f"{bool(is_accepted[k])}")
+
+        if not is_accepted.any():
+            return None, None
+
+        # Taking the first accepted candidate is the same as trying them one after another.
+        k = int(th.nonzero(is_accepted)[0])
+        state = states[k] if states is not None else None
+
+        return bool(delta_g_e + delta_g_v < delta_g_e_aug[k] + delta_g_v_aug[k]), state
+
+    def _log_ratios(self, batches, q, q_aug):
+        """
+        Yield the log acceptance ratio of every candidate on each seed batch.
+        """
+        for ent, delta_g_e_, delta_g_aug_e_ in batches:
+            p = log_target(self.args, delta_g_e_, ent)
+            p_aug = log_target(self.args, delta_g_aug_e_, ent.unsqueeze(1))
+
+            yield (p_aug.sum(0) - p.sum()) - (q_aug - q)
+
+    def _sequential_test(self, log_ratios, num_proposals):
+        """
+        Decide the proposals on as few seed batches as the tolerance allows.
+
+        Batches are drawn in random order, one per rank per step, and the running mean and
+        variance of their log acceptance ratios are pooled over all ranks. Drawing stops once
+        a t-test with finite population correction tells, for every candidate, on which side
+        of log(u) the full mean lies with error below ``args.mh_tolerance``, or when the
+        batches run out. All ranks see the same pooled statistics, so they stop together.
+
+        Returns
+        -------
+        log(u) and the mean log acceptance ratio over the drawn batches, per candidate.
+        """
+        size = dist.get_world_size(self.group)
+
+        rv = th.tensor([float(np.log(random.random())) for _ in range(num_proposals)], dtype=th.float64)
+        total = th.tensor([float(math.ceil(len(self.train_nid) / self.args.batch_size))])
+        with metrics.timer("mh/collective"):
+            dist.all_reduce(rv, op=dist.ReduceOp.SUM, group=self.group)
+            dist.all_reduce(total, op=dist.ReduceOp.SUM, group=self.group)
+        rv /= size
+        total = float(total)
+
+        # Sum, sum of squares and number of the drawn ratios.
+        stats = th.zeros(3, num_proposals, dtype=th.float64)
+        while True:
+            step = th.zeros(3, num_proposals, dtype=th.float64)
+            log_ratio = next(log_ratios, None)
+            if log_ratio is not None:
+                step[0] = log_ratio
+                step[1] = log_ratio ** 2
+                step[2] = 1
+            with metrics.timer("mh/collective"):
+                dist.all_reduce(step, op=dist.ReduceOp.SUM, group=self.group)
+            stats += step
+
+            num = float(stats[2, 0])
+            if num >= total or step[2, 0] == 0:
+                break
+            if num < 2:
+                continue
+
+            mean = stats[0] / num
+            std = ((stats[1] - num * mean ** 2) / (num - 1)).clamp(min=0).sqrt()
+            std_err = std / math.sqrt(num) * math.sqrt(1 - (num - 1) / (total - 1))
+            t_stat = ((mean - rv).abs() / std_err).numpy()
+            if (student_t.sf(t_stat, num - 1) < self.args.mh_tolerance).all():
+                break
+
+        log_ratios.close()
+        self._drain()
+
+        if self.args.mh_verbose:
+            print(f"{self.g.rank()}'s mh-aug: decided on {int(stats[2, 0])} of {int(total)} batches")
+        return rv, stats[0] / stats[2]
+
+    def _drain(self):
+        """
+        Collect the batches the sampler processes still prepare for a sweep that stopped early.
+
+        The loader asks its sampler processes for batches ahead of the consumer and forgets
+        about them when iterated again, so they would come out of the next sweep instead,
+        sampled on masks and seeds that no longer hold.
+        """
+        loader = self.dataloader.org_dataloader if isinstance(self.dataloader, AugDataLoader) else self.dataloader
+        if loader.pool is None:
+            return
+        with RPC_LOCK:
+            while loader.num_pending > 0:
+                loader.pool.get_result(loader.name, timeout=1800)
+                loader.num_pending -= 1
+
+    def _entropy(self, model, input_nodes, seeds, blocks):
+        """
+        Normalized entropy of the class predictions of the seed nodes, from the cache while it is fresh.
+
+        Stale seeds run through every model layer, so the entropies computed here and the ones
+        the training loop caches are the same quantity.
+        """
+        if self.ent_cache is not None and self.ent_cache.fresh(seeds).all():
+            return self.ent_cache(seeds).to(self.device)
+
+        # The blocks nearest the seeds, one per model layer.
+        blocks = blocks[-self.args.num_layers:]
+        input_nodes = blocks[0].srcdata[dgl.NID]
+        with RPC_LOCK, metrics.timer("mh/fetch"):
+            batch_inputs = self.features[input_nodes]
+        batch_inputs = batch_inputs.to(self.device)
+        blocks = [block.to(self.device) for block in blocks]
+        batch_pred = model(blocks, batch_inputs)
+
+        ent = normalized_entropy(batch_pred)
+        if self.ent_cache is not None:
+            self.ent_cache.update(seeds, ent)
+        return ent
+
+    def _seed_batches(self):
+        """
+        Seed batches of the training nodes, without sampling, for when no model forward is needed.
+        """
+        num_seeds = len(self.train_nid)
+        order = th.randperm(num_seeds) if self.shuffle else th.arange(num_seeds)
+        for pos in th.split(order, self.args.batch_size):
+            yield self.train_nid[pos]
+
+    def _agg_org_ego(self, fanout):
+        """
+        Ego-graph sizes of all seeds on the original graph, aggregated with ``SimpleAGG``.
+
+        Only the original graph is sampled, so the masked views are not sampled for nothing.
+        """
+        org_ego = th.empty(len(self.train_nid), device=self.device)
+        ones = self.g.ndata["ones"]
+        dataloader = dgl.dataloading.DistNodeDataLoader(
+            self.g, self.train_nid, dgl.dataloading.NeighborSampler(fanout, mask=None),
+            batch_size=self.args.batch_size, shuffle=False, drop_last=False, device="cpu")
+        for input_nodes, seeds, blocks in dataloader:
+            blocks = [block.to(self.device) for block in blocks]
+            batch_ones = ones[input_nodes].to(self.device)
+            org_ego[self.seed_index(seeds)] = aggregate(blocks, self.agg_model, batch_ones).squeeze(1)
+        return org_ego
+
+    def _agg_batches(self, model):
+        """
+        Yield the entropy and the prev/cur change ratios of each seed batch,
+        aggregating ones over sampled full-neighbor blocks with ``SimpleAGG``.
+        """
+        agg_model = self.agg_model
+
+        ones = self.g.ndata["ones"]
+
+        for src_and_blocks in self.dataloader:
+            org_input_nodes, org_seeds, org_blocks = src_and_blocks["org"]
+            _, _, prev_blocks = src_and_blocks["prev"]
+            _, _, cur_blocks = src_and_blocks["cur"]
+
+            # The ego-graphs span the blocks nearest the seeds, one per hop.
+            prev_blocks, cur_blocks = prev_blocks[-self.num_hop:], cur_blocks[-self.num_hop:]
+            prev_ones = ones[prev_blocks[0].srcdata[dgl.NID]].to(self.device)
+            cur_ones = ones[cur_blocks[0].srcdata[dgl.NID]].to(self.device)
+
+            # Move to target device.
+            prev_blocks = [block.to(self.device) for block in prev_blocks]
+            cur_blocks = [block.to(self.device) for block in cur_blocks]
+
+            ent = self._entropy(model, org_input_nodes, org_seeds, org_blocks)
+
+            batch_org_ego = self.org_ego[self.seed_index(org_seeds)]
+
+            delta_prev = 1 - aggregate(prev_blocks, agg_model, prev_ones).squeeze(1) / batch_org_ego
+            delta_cur = 1 - aggregate(cur_blocks, agg_model, cur_ones) / batch_org_ego.unsqueeze(1)
+            yield ent, delta_prev, delta_cur
+
+    def _sparse_batches(self, model, base="prev", states=None):
+        """
+        Yield the entropy and the base/cur change ratios of each seed batch,
+        reading the ratios from ego-graph sizes counted once for all seeds.
+        With a fresh entropy cache, no seed batch is sampled.
+
+        With counter-based candidate ``states``, every candidate is counted as its own "cur"
+        view in the same sweep.
+        """
+        if states is None:
+            cur_weights = [self.ego_counter.edge_weights(self.masks, "cur")]
+        else:
+            cur_weights = [self.masks.state_keep(state, "emask", self.ego_counter.eids).float().view(-1, 1)
+                           for state in states]
+        weights = th.cat([self.ego_counter.edge_weights(self.masks, base)] + cur_weights, dim=1)
+        ego = self.ego_counter(weights).to(self.device)
+
+        if self.ent_cache is not None and self.ent_cache.fresh(self.train_nid).all():
+            # Every entropy is cached, so the seeds need neither sampling nor a forward pass.
+            batches = ((None, seeds, None) for seeds in self._seed_batches())
         else:
-            return g, False
-    else:
-        return g, None
+            batches = locked(self.dataloader)
+
+        for input_nodes, seeds, blocks in batches:
+            ent = self._entropy(model, input_nodes, seeds, blocks)
+
+            pos = self.seed_index(seeds)
+            batch_ego, batch_org_ego = ego[pos], self.org_ego[pos].unsqueeze(1)
+            yield ent, 1 - batch_ego[:, 0] / batch_org_ego[:, 0], 1 - batch_ego[:, 1:] / batch_org_ego
+
+
+def log_target(args, delta, ent):
+    """
+    Log-density of the target distribution of a change ratio, given the prediction entropy.
+
+    Node masking is measured through the same ego-graph ratio as edge masking.
+    """
+    return (args.lam1_e * log_normal(delta, args.mu_e, args.a_e * ent + args.b_e) +
+            args.lam1_v * log_normal(delta, args.mu_v, args.a_v * ent + args.b_v))
+
+
+def log_proposal(args, delta_g_e, delta_g_v, from_e, from_v, num_edges, num_nodes):
+    """
+    Log-density of proposing (delta_g_e, delta_g_v) from (from_e, from_v) with the truncated
+    normal proposal, plus the beta normalization of the proposed state.
+    """
+    a_e, b_e = (0 - from_e) / args.sigma_delta_e, (1 - from_e) / args.sigma_delta_e
+    a_v, b_v = (0 - from_v) / args.sigma_delta_v, (1 - from_v) / args.sigma_delta_v
+    return (truncnorm.logpdf(delta_g_e, a_e, b_e, loc=from_e, scale=args.sigma_delta_e) +
+            args.lam2_e * betaln(num_edges - num_edges * delta_g_e + 1, num_edges * delta_g_e + 1) +
+            truncnorm.logpdf(delta_g_v, a_v, b_v, loc=from_v, scale=args.sigma_delta_v) +
+            args.lam2_v * betaln(num_nodes - num_nodes * delta_g_v + 1, num_nodes * delta_g_v + 1))
+
+
+class AsyncMHAug:
+    """
+    Metropolis-Hastings Augmentation in a background thread, overlapped with training
+
+    While epoch t trains on its accepted masks, the worker proposes the masks of epoch t+1
+    from them and evaluates the proposals against a snapshot of the model, which the training
+    loop refreshes every ``staleness`` steps. The accepted proposal comes back through a queue
+    of size one and is set as the "cur" masks at the start of the next epoch.
+
+    The worker never writes masks, so ``mh_aug`` has to evaluate proposals by their
+    counter-based state (``--masking hash`` with ``--ego_engine sparse``). Its collectives
+    run on the process group of ``mh_aug``, which must not be the one used by training.
+
+    Parameters
+    ----------
+    mh_aug : MHAug
+        The augmentation to run.
+    model : torch.nn.Module
+        The trained model, without the DDP wrapper.
+    staleness : int
+        Number of training steps after which the model snapshot is refreshed.
+    """
+
+    def __init__(self, mh_aug, model, staleness):
+        if not mh_aug.by_state or mh_aug.group is None:
+            raise RuntimeError("Asynchronous augmentation needs --masking hash, --ego_engine sparse "
+                               "and a process group of its own")
+        self.mh_aug = mh_aug
+        self.staleness = staleness
+        self.num_steps = 0
+        self.snapshot = None
+        self.publish(model)
+
+        self.requests = queue.Queue()
+        self.results = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def publish(self, model):
+        """
+        Replace the model snapshot the worker evaluates proposals with.
+        """
+        snapshot = copy.deepcopy(model)
+        snapshot.eval()
+        # The worker picks up the new reference at its next proposal.
+        self.snapshot = snapshot
+
+    def step(self, model):
+        """
+        Count a training step, refreshing the snapshot when it gets too stale.
+        """
+        self.num_steps += 1
+        if self.num_steps % self.staleness == 0:
+            self.publish(model)
+
+    def request(self):
+        """
+        Start proposing the masks of the next epoch from the current "cur" masks.
+        """
+        self.requests.put(True)
+
+    def result(self):
+        """
+        Wait for the accepted proposal and set it as the "cur" masks. Call after ``promote``.
+
+        Returns
+        -------
+        kl_loss_opt : bool
+            Whether the accepted proposal masks more than the previous one.
+        """
+        result = self.results.get()
+        if isinstance(result, Exception):
+            raise result
+        kl_loss_opt, state = result
+        self.mh_aug.masks.set_state("cur", state)
+        return kl_loss_opt
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _run(self):
+        rank = self.mh_aug.g.rank()
+        while self.requests.get() is not None:
+            try:
+                while True:
+                    print(f"{rank}: Trying Metropolis-Hastings Augmentation in the background...")
+                    with metrics.timer("mh/propose"):
+                        kl_loss_opt, state = self.mh_aug.propose(self.snapshot, base="cur")
+                    if kl_loss_opt is not None:
+                        print(f"{rank}: Metropolis-Hastings Augmentation Accepted!!!")
+                        break
+                self.results.put((kl_loss_opt, state))
+            except Exception as e:
+                self.results.put(e)
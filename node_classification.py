@@ -9,16 +9,27 @@ import torch.nn as nn
 import torch.distributed as dist
 import torch.nn.functional as F
 import torch.optim as optim
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
 
 from training.evaluation import compute_acc, evaluate
 from training.model import DistSAGE
-from training.loss import HLoss, XeLoss, JensenShannon
+from training.local_sgd import LocalSGD
+from training.loss import HLoss, XeLoss, JensenShannon, FusedLoss, normalized_entropy
 
-from mh_aug import mh_aug
+from mh_aug import MHAug, AsyncMHAug
 from common.set_graph import SetGraph
-from common.load_batch import AugDataLoader
+from common.load_batch import AugDataLoader, MaskedNeighborSampler, union_views
 from common.config import CONFIG
+from common.mask_store import MaskStore, MASK_DTYPES
+from common.masked_features import MaskedFeatures
 from common.calc import one_hot_encode
+from common import metrics, trace
+from common.rpc import RPC_LOCK
+from common.entropy_cache import EntropyCache
+from common.feature_cache import FeatureCache
+from common.block_store import BlockStore
+from common.seed_order import locality_order
+from common.checkpoint import Checkpointer, resume
 
 
 def init(shape, dtype):
@@ -43,36 +54,54 @@ def run(args, device, data):
     # Initial var declare and copy for augmentation training
     train_nid, val_nid, test_nid, in_feats, n_classes, g = data
 
-    num_edges = g.num_edges()
+    trace.configure(args.trace_dir, g.rank())
+    metrics.configure(args.metrics_dir, g.rank())
+
     num_nodes = g.num_nodes()
 
-    g.ndata["prev_features"] = g.ndata["features"][0:num_nodes]
-    g.ndata["cur_features"] = g.ndata["features"][0:num_nodes]
+    if args.seed_order == "locality":
+        # Consecutive seeds share their neighborhoods, in the training loader and in mh_aug.
+        train_nid = locality_order(g, train_nid)
 
     g.ndata["ones"] = dgl.distributed.DistTensor((num_nodes, 1), th.float32,
                                                  name='mpv', init_func=init)  # mpv: message passing value
 
-    g.edata['org_emask'] = dgl.distributed.DistTensor((num_edges, 1), th.float32,
-                                                      name='org_emask', init_func=init)
-    g.edata['prev_emask'] = dgl.distributed.DistTensor((num_edges, 1), th.float32,
-                                                       name='prev_emask', init_func=init)
-    g.edata['cur_emask'] = dgl.distributed.DistTensor((num_edges, 1), th.float32,
-                                                      name='cur_emask', init_func=init)
-
-    g.ndata['org_nmask'] = dgl.distributed.DistTensor((num_nodes, 1), th.float32,
-                                                      name='org_nmask', init_func=init)
-    g.ndata['prev_nmask'] = dgl.distributed.DistTensor((num_nodes, 1), th.float32,
-                                                       name='prev_nmask', init_func=init)
-    g.ndata['cur_nmask'] = dgl.distributed.DistTensor((num_nodes, 1), th.float32,
-                                                      name='cur_nmask', init_func=init)
+    mask_seed = None
+    if args.masking == "hash":
+        # Counter-based masks need the same seed on every trainer.
+        mask_seed = th.tensor([args.mask_seed if args.mask_seed is not None else np.random.randint(2 ** 31)])
+        dist.broadcast(mask_seed, 0)
+        mask_seed = int(mask_seed.item())
+    # Without server-side masked sampling, counter-based masks need no storage.
+    masks = MaskStore(g, dtype=MASK_DTYPES[args.mask_dtype], seed=mask_seed,
+                      stored=not (args.masking == "hash" and args.fused_sampling))
+    features = g.ndata["features"]
+    if args.feature_cache_mb > 0:
+        features = FeatureCache(g, features, args.feature_cache_mb, args.feature_cache_lru)
+    prev_features = MaskedFeatures(features, masks, "prev")
+    cur_features = MaskedFeatures(features, masks, "cur")
 
     # Declare Sampler and DataLoader
     fanout = [int(fanout) for fanout in args.fan_out.split(",")]
     samplers = [dgl.dataloading.NeighborSampler(fanout, mask=None),
-                dgl.dataloading.NeighborSampler(fanout, mask="prev_emask"),
-                dgl.dataloading.NeighborSampler(fanout, mask="cur_emask")]
+                MaskedNeighborSampler(fanout, masks, "prev"),
+                MaskedNeighborSampler(fanout, masks, "cur")]
+    # The loader gathers features and labels too, so prefetching hides them behind training.
     dataloader = AugDataLoader(g, samplers, train_nid,
-                               batch_size=args.batch_size, shuffle=False, drop_last=False, device="cpu")
+                               batch_size=args.batch_size, shuffle=False, drop_last=False, device="cpu",
+                               fused=args.fused_sampling,
+                               features={"org": features, "prev": prev_features, "cur": cur_features},
+                               labels=g.ndata["labels"], prefetch=args.prefetch,
+                               block_store=BlockStore(args.block_spill_dir) if args.reuse_cur_blocks else None,
+                               cluster_shuffle=args.cluster_shuffle,
+                               feature_dtype=th.bfloat16 if args.precision == "bf16" else None)
+
+    # Declare Augmentation
+    # A background worker needs collectives of its own beside the DDP ones.
+    aug_group = dist.new_group(backend="gloo") if args.async_aug else None
+    # Prediction entropy of the seeds, reused by mh_aug instead of a model forward.
+    ent_cache = EntropyCache(train_nid, refresh=args.ent_refresh) if args.ent_cache else None
+    mh_aug = MHAug(args, g, masks, train_nid, device, group=aug_group, ent_cache=ent_cache, features=features)
 
     # Declare Training Methods
     model = DistSAGE(
@@ -88,18 +117,38 @@ def run(args, device, data):
         model = th.nn.parallel.DistributedDataParallel(model)
     else:
         model = th.nn.parallel.DistributedDataParallel(model, device_ids=[device], output_device=device)
+    if args.precision == "bf16":
+        # Weights and the optimizer stay float32; only the gradient all-reduce is sent as bf16.
+        model.register_comm_hook(None, default_hooks.bf16_compress_hook)
     # Declare Loss Functions
     hard_xe_loss_op = nn.CrossEntropyLoss()
     soft_xe_loss_op = XeLoss()
     h_loss_op = HLoss()
     js_loss_op = JensenShannon()
+    fused_loss_op = FusedLoss(n_classes, args.kl, args.h, args.option_loss)
 
     # Declare Optimizer
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.decay)
 
+    # Continue the MH chain from the checkpointed masks instead of a fresh warmup.
+    start_epoch = 0
+    if args.resume:
+        start_epoch = resume(args.checkpoint_dir, g.rank(), model.module, optimizer, masks)
+        print(f"Part {g.rank()}: Resumed from epoch {start_epoch}")
+    checkpointer = Checkpointer(args.checkpoint_dir, g.rank()) if args.checkpoint_dir else None
+
+    aug_worker = AsyncMHAug(mh_aug, model.module, args.aug_staleness) if args.async_aug else None
+
+    # Local SGD bypasses the DDP wrapper, which would all-reduce gradients every step.
+    local_sgd = None
+    net = model
+    if args.sync_every > 1:
+        local_sgd = LocalSGD(model.module, optimizer, args.sync_every, args.sync_optim_state)
+        net = model.module
+
     # Training loop.
     batch_time = []  # time check per batch
-    epoch = 0  # epoch count
+    epoch = start_epoch  # epoch count
     epoch_time = []  # time check per epoch
     test_acc = 0.0  # get accuracy per epoch
     while epoch < args.num_epochs:
@@ -114,58 +163,74 @@ def run(args, device, data):
         num_inputs = 0
         start = time.time()
         step_time = []
-
-        with model.join():
-            while True:
-                print(f"{g.rank()}: Trying Metropolis-Hastings Augmentation...")
-                cur_g, kl_loss_opt = mh_aug(args, g, model, train_nid, device)
-                if kl_loss_opt is not None:
-                    print("Metropolis-Hastings Augmentation Accepted!!!")
-                    break
+        if ent_cache is not None:
+            ent_cache.epoch = epoch
+
+        # Ranks that run out of batches wait for the others when leaving the join.
+        with metrics.timed_exit("train/join_wait", model.join()):
+            # The augmentation accepted last epoch becomes the state the chain moves from.
+            if epoch > 1:
+                masks.promote()
+            if aug_worker is not None and epoch > start_epoch + 1:
+                # Proposed and evaluated in the background during the last epoch.
+                kl_loss_opt = aug_worker.result()
+            else:
+                while True:
+                    print(f"{g.rank()}: Trying Metropolis-Hastings Augmentation...")
+                    cur_g, kl_loss_opt = mh_aug(model)
+                    if kl_loss_opt is not None:
+                        print("Metropolis-Hastings Augmentation Accepted!!!")
+                        break
+            if aug_worker is not None and epoch < args.num_epochs:
+                aug_worker.request()
+            if local_sgd is not None:
+                local_sgd.start_epoch(len(train_nid), args.batch_size)
 
             for step, src_and_blocks in enumerate(dataloader):
                 # input_nodes: src nodes, i.e. whole MFG's nodes
                 # seeds: dst nodes
                 # blocks: Message Flow Graph
 
+                # The loader has already sliced the features and labels.
                 org = src_and_blocks["org"]
-                org_input_nodes = org[0]
                 org_dst_nodes = org[1]
                 org_blocks = org[2]
+                org_batch_inputs = org[3]
+                org_batch_labels = org[4]
 
                 prev = src_and_blocks["prev"]
-                prev_input_nodes = prev[0]
-                prev_dst_nodes = prev[1]
                 prev_blocks = prev[2]
+                prev_batch_inputs = prev[3]
+                prev_batch_labels = prev[4]
 
                 cur = src_and_blocks["cur"]
-                cur_input_nodes = cur[0]
-                cur_dst_nodes = cur[1]
                 cur_blocks = cur[2]
+                cur_batch_inputs = cur[3]
 
                 # Declare time variable to calculate computing time
                 tic_step = time.time()
                 sample_time += tic_step - start
-
-                # Slice feature and label.
-                org_batch_inputs = g.ndata["features"][org_input_nodes]
-                prev_batch_inputs = g.ndata["features"][prev_input_nodes]
-                cur_batch_inputs = g.ndata["features"][cur_input_nodes]
-
-                org_batch_labels = g.ndata["labels"][org_dst_nodes].long()
-                prev_batch_labels = g.ndata["labels"][prev_dst_nodes].long()
+                metrics.add_time("train/sample", tic_step - start)
 
                 num_seeds += len(org_blocks[-1].dstdata[dgl.NID])
                 num_inputs += len(org_blocks[0].srcdata[dgl.NID])
 
-                # Move to target device.
-                org_blocks = [block.to(device) for block in org_blocks]
-                prev_blocks = [block.to(device) for block in prev_blocks]
-                cur_blocks = [block.to(device) for block in cur_blocks]
+                if args.fused_forward:
+                    # One forward over the disjoint union of the three views' blocks.
+                    union_blocks, union_inputs, num_outputs = union_views(
+                        [org_blocks, prev_blocks, cur_blocks],
+                        [org_batch_inputs, prev_batch_inputs, cur_batch_inputs])
+                    union_blocks = [block.to(device) for block in union_blocks]
+                    union_inputs = union_inputs.to(device)
+                else:
+                    # Move to target device.
+                    org_blocks = [block.to(device) for block in org_blocks]
+                    prev_blocks = [block.to(device) for block in prev_blocks]
+                    cur_blocks = [block.to(device) for block in cur_blocks]
 
-                org_batch_inputs = org_batch_inputs.to(device)
-                prev_batch_inputs = prev_batch_inputs.to(device)
-                cur_batch_inputs = cur_batch_inputs.to(device)
+                    org_batch_inputs = org_batch_inputs.to(device)
+                    prev_batch_inputs = prev_batch_inputs.to(device)
+                    cur_batch_inputs = cur_batch_inputs.to(device)
 
                 org_batch_labels = org_batch_labels.to(device)
                 prev_batch_labels = prev_batch_labels.to(device)
@@ -173,25 +238,41 @@ def run(args, device, data):
                 # Compute loss and prediction.
                 start = time.time()
 
-                batch_pred = model(org_blocks, org_batch_inputs)
-                batch_prev_pred = model(prev_blocks, prev_batch_inputs)
-                batch_cur_pred = model(cur_blocks, cur_batch_inputs)
+                with th.autocast(device.type, dtype=th.bfloat16, enabled=args.precision == "bf16"):
+                    if args.fused_forward:
+                        batch_pred, batch_prev_pred, batch_cur_pred = \
+                            net(union_blocks, union_inputs).split(num_outputs)
+                    else:
+                        batch_pred = net(org_blocks, org_batch_inputs)
+                        batch_prev_pred = net(prev_blocks, prev_batch_inputs)
+                        batch_cur_pred = net(cur_blocks, cur_batch_inputs)
+                # The losses are computed in float32.
+                batch_pred, batch_prev_pred, batch_cur_pred = \
+                    batch_pred.float(), batch_prev_pred.float(), batch_cur_pred.float()
 
                 forward_end = time.time()
+                metrics.add_time("train/forward", forward_end - start)
 
-                one_hot_prev_batch_labels = one_hot_encode(prev_batch_labels, n_classes)
+                if ent_cache is not None:
+                    ent_cache.update(org_dst_nodes, normalized_entropy(batch_pred))
 
-                loss_XE = hard_xe_loss_op(batch_prev_pred, prev_batch_labels)
-                if args.option_loss == 0:
-                    loss_KL = soft_xe_loss_op(batch_prev_pred, one_hot_prev_batch_labels)
+                if args.fused_loss:
+                    total_loss, loss_XE, loss_KL, loss_H = fused_loss_op(
+                        batch_pred, batch_prev_pred, batch_cur_pred, prev_batch_labels, kl_loss_opt)
                 else:
-                    if kl_loss_opt:
-                        loss_KL = js_loss_op(batch_prev_pred.detach(), batch_cur_pred)
+                    one_hot_prev_batch_labels = one_hot_encode(prev_batch_labels, n_classes)
+
+                    loss_XE = hard_xe_loss_op(batch_prev_pred, prev_batch_labels)
+                    if args.option_loss == 0:
+                        loss_KL = soft_xe_loss_op(batch_prev_pred, one_hot_prev_batch_labels)
                     else:
-                        loss_KL = js_loss_op(batch_prev_pred, batch_cur_pred.detach())
-                loss_H = h_loss_op(batch_pred)
+                        if kl_loss_opt:
+                            loss_KL = js_loss_op(batch_prev_pred.detach(), batch_cur_pred)
+                        else:
+                            loss_KL = js_loss_op(batch_prev_pred, batch_cur_pred.detach())
+                    loss_H = h_loss_op(batch_pred)
 
-                total_loss = loss_XE + args.kl * loss_KL + args.h * loss_H
+                    total_loss = loss_XE + args.kl * loss_KL + args.h * loss_H
 
                 optimizer.zero_grad()
                 total_loss.backward()
@@ -200,34 +281,46 @@ def run(args, device, data):
                 compute_end = time.time()
                 forward_time += forward_end - start
                 backward_time += compute_end - forward_end
+                metrics.add_time("train/backward", compute_end - forward_end)
 
                 optimizer.step()
+                if local_sgd is not None:
+                    local_sgd.step(step)
                 update_time += time.time() - compute_end
+                metrics.add_time("train/update", time.time() - compute_end)
+                metrics.count("train/seeds", len(org_dst_nodes))
+                if aug_worker is not None:
+                    aug_worker.step(model.module)
 
                 step_t = time.time() - tic_step
                 step_time.append(step_t)
                 batch_time.append(len(org_blocks[-1].dstdata[dgl.NID]) / step_t)
 
-                acc = compute_acc(batch_pred, org_batch_labels)
-                gpu_mem_alloc = (
-                    th.cuda.max_memory_allocated() / 1000000
-                    if th.cuda.is_available()
-                    else 0
-                )
-
-                sample_speed = np.mean(batch_time[-args.log_every:])
-                mean_step_time = np.mean(step_time[-args.log_every:])
-
-                print(
-                    f"Part {g.rank()} | Epoch {epoch:05d} | Step {step:05d}"
-                    f" | Loss {total_loss.item():.4f} | Train Acc {acc:.4f}"
-                    f" | Speed (samples/sec) {sample_speed:.4f}"
-                    f" | GPU {gpu_mem_alloc:.1f} MB | "
-                    f"Mean step time {mean_step_time:.3f} s"
-                )
+                # Reading the loss and accuracy waits for the step, so it is only done when logging.
+                if step % args.log_every == 0:
+                    acc = compute_acc(batch_pred, org_batch_labels)
+                    gpu_mem_alloc = (
+                        th.cuda.max_memory_allocated() / 1000000
+                        if th.cuda.is_available()
+                        else 0
+                    )
+
+                    sample_speed = np.mean(batch_time[-args.log_every:])
+                    mean_step_time = np.mean(step_time[-args.log_every:])
+
+                    print(
+                        f"Part {g.rank()} | Epoch {epoch:05d} | Step {step:05d}"
+                        f" | Loss {total_loss.item():.4f} | Train Acc {acc:.4f}"
+                        f" | Speed (samples/sec) {sample_speed:.4f}"
+                        f" | GPU {gpu_mem_alloc:.1f} MB | "
+                        f"Mean step time {mean_step_time:.3f} s"
+                    )
 
                 start = time.time()
 
+            if local_sgd is not None:
+                local_sgd.end_epoch()
+
         toc = time.time()
         print(
             f"Part {g.rank()}, Epoch Time(s): {toc - tic:.4f}, "
@@ -235,24 +328,47 @@ def run(args, device, data):
             f" backward: {backward_time:.4f}, update: {update_time:.4f}, "
             f"#seeds: {num_seeds}, #inputs: {num_inputs}"
         )
+        if isinstance(features, FeatureCache):
+            print(f"Part {g.rank()}, Feature cache hit rate: {features.hit_rate:.4f} "
+                  f"({features.hits} hits, {features.misses} misses)")
         epoch_time.append(toc - tic)
+        metrics.add_time("train/epoch", toc - tic)
 
         if epoch % args.eval_every == 0 or epoch == args.num_epochs:
             start = time.time()
-            val_acc, test_acc = evaluate(
-                model.module,
-                g,
-                g.ndata["features"],
-                g.ndata["labels"],
-                val_nid,
-                test_nid,
-                args.batch_size_eval,
-                device,
-            )
+            # Inference does not take turns with a background worker request by request. It waits on
+            # graph server barriers with the lock held, which the worker never does with its collectives.
+            with RPC_LOCK:
+                val_acc, test_acc = evaluate(
+                    model.module,
+                    g,
+                    features,
+                    g.ndata["labels"],
+                    val_nid,
+                    test_nid,
+                    args.batch_size_eval,
+                    device,
+                )
             print(
                 f"Part {g.rank()}, Val Acc {val_acc:.4f}, "
                 f"Test Acc {test_acc:.4f}, time: {time.time() - start:.4f}"
                 )
+            metrics.add_time("eval", time.time() - start)
+            metrics.observe("eval/val_acc", val_acc)
+            metrics.observe("eval/test_acc", test_acc)
+
+        metrics.flush(epoch)
+        trace.flush()
+
+        if checkpointer is not None and (epoch % args.checkpoint_every == 0 or epoch == args.num_epochs):
+            checkpointer.save(epoch, model.module, optimizer, masks)
+
+    if aug_worker is not None:
+        aug_worker.close()
+    if checkpointer is not None:
+        checkpointer.wait()
+    metrics.close()
+    trace.close()
 
     return epoch_time, test_acc
 
@@ -284,7 +400,7 @@ def main(args):
 
     print(
         f"Summary of node classification(GraphSAGE): GraphName "
-        f"{args.graph_name} | TrainEpochTime(sum) {np.sum(epoch_time):.4f} "
+        f"{args.graph_name} | Precision {args.precision} | TrainEpochTime(sum) {np.sum(epoch_time):.4f} "
         f"| TestAccuracy {test_acc:.4f}"
     )
 
@@ -298,7 +414,7 @@ def main(args):
     if g.rank() == 0:
         with open('results/'+args.graph_name+'.txt', 'a') as f:
             f.write(f"Summary of node classification(GraphSAGE): GraphName "
-                    f"{args.graph_name} | TrainEpochTime(sum) {all_epoch_time:.4f} "
+                    f"{args.graph_name} | Precision {args.precision} | TrainEpochTime(sum) {all_epoch_time:.4f} "
                     f"| TestAccuracy {all_test_acc:.4f}\n")
 
 
@@ -329,10 +445,90 @@ if __name__ == "__main__":
     parser.add_argument("--decay", type=float, default=0.0005)
     parser.add_argument("--dropout", type=float, default=0.5)
     parser.add_argument("--option_loss", type=int, default=0)
+    parser.add_argument("--fused_sampling", default=False, action="store_true",
+        help="Sample each seed batch once and derive the prev/cur views by filtering it with the edge masks.")
+    parser.add_argument("--ego_engine", type=str, default="agg", choices=["agg", "sparse"],
+        help="How mh_aug counts ego-graph sizes: SimpleAGG over sampled blocks, "
+             "or sparse aggregation over the local partition.")
+    parser.add_argument("--org_ego_path", type=str, default=None,
+        help="Ego-graph sizes of the original graph written by partition_graph.py --save_org_ego. "
+             "Counted at startup when not given.")
+    parser.add_argument("--masking", type=str, default="global", choices=["global", "local", "hash"],
+        help="Draw the proposed masks over the whole graph on every trainer, "
+             "only over the nodes and edges owned by each trainer's partition, "
+             "or regenerate them on demand from a counter-based hash of (seed, ID).")
+    parser.add_argument("--mask_seed", type=int, default=None,
+        help="Base seed of --masking hash, for reproducible runs. Drawn by rank 0 when not given.")
+    parser.add_argument("--mask_dtype", type=str, default="float32", choices=list(MASK_DTYPES),
+        help="Storage type of the edge and node masks. bool takes a quarter of the memory.")
+    parser.add_argument("--num_proposals", type=int, default=1,
+        help="MH proposals evaluated together in one sweep over the training seeds; the first "
+             "accepted one is taken. More than one needs --ego_engine sparse and --masking hash.")
+    parser.add_argument("--mh_tolerance", type=float, default=None,
+        help="Error tolerance of the sequential MH acceptance test, which stops drawing seed batches "
+             "once the decision is settled. By default every batch is evaluated.")
+    parser.add_argument("--async_aug", default=False, action="store_true",
+        help="Propose and evaluate the next epoch's augmentation in a background thread while the "
+             "current epoch trains. Needs --masking hash and --ego_engine sparse.")
+    parser.add_argument("--aug_staleness", type=int, default=50,
+        help="Training steps after which the model snapshot used by --async_aug is refreshed.")
+    parser.add_argument("--ent_cache", default=False, action="store_true",
+        help="Keep the prediction entropy of the training seeds from the training pass and let "
+             "mh_aug read it instead of running the model.")
+    parser.add_argument("--ent_refresh", type=int, default=1,
+        help="Epochs a cached entropy stays valid; older entries are recomputed by mh_aug.")
+    parser.add_argument("--prefetch", type=int, default=0,
+        help="Number of training batches sampled and gathered ahead by a background thread.")
+    parser.add_argument("--feature_cache_mb", type=float, default=0,
+        help="Memory budget of the per-trainer cache of remote feature rows, filled with the "
+             "highest in-degree halo nodes. 0 disables the cache.")
+    parser.add_argument("--feature_cache_lru", type=float, default=0.0,
+        help="Share of --feature_cache_mb given to an LRU tier for rows outside the static set.")
+    parser.add_argument("--reuse_cur_blocks", default=False, action="store_true",
+        help="Keep every batch's cur blocks and serve them as its prev blocks in the next epoch, "
+             "skipping the prev sampling pass.")
+    parser.add_argument("--block_spill_dir", type=str, default=None,
+        help="Spill the blocks kept by --reuse_cur_blocks to memory-mapped files in this "
+             "directory instead of keeping them in memory.")
+    parser.add_argument("--seed_order", type=str, default="id", choices=["id", "locality"],
+        help="Order of the training seeds in batches: by node ID, or by a reverse Cuthill-McKee "
+             "ordering of the local partition so that batches share their neighborhoods.")
+    parser.add_argument("--cluster_shuffle", default=False, action="store_true",
+        help="Shuffle the order of whole training batches every epoch, keeping each batch's seeds together.")
+    parser.add_argument("--fused_forward", default=False, action="store_true",
+        help="Run the org/prev/cur views through one model forward over the disjoint union of their blocks.")
+    parser.add_argument("--fused_loss", default=False, action="store_true",
+        help="Compute the cross entropy, consistency and entropy losses in one pass with closed-form "
+             "gradients. Check and benchmark it with python3 -m training.loss.")
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16"],
+        help="bf16 gathers feature batches in bfloat16, runs the model forward under autocast "
+             "and all-reduces bf16 gradients, keeping float32 weights in the optimizer.")
+    parser.add_argument("--sync_every", type=int, default=1,
+        help="Local SGD: take this many optimizer steps on local gradients between parameter "
+             "averages across ranks. 1 all-reduces gradients every step through DDP.")
+    parser.add_argument("--sync_optim_state", default=False, action="store_true",
+        help="With --sync_every, also average the Adam moment estimates.")
+    parser.add_argument("--mh_verbose", default=False, action="store_true",
+        help="Print log(u) and the acceptance of every MH proposal, which --metrics_dir records anyway.")
+    parser.add_argument("--metrics_dir", type=str, default=None,
+        help="Write per-phase counters, timers and histograms of every rank to JSONL files in "
+             "this directory, aggregated over ranks at every epoch end.")
+    parser.add_argument("--trace_dir", type=str, default=None,
+        help="Write a Chrome/Perfetto trace of every rank's training phases, augmentation, "
+             "feature fetches and collectives to this directory. Merge them with merge_traces.py.")
+    parser.add_argument("--checkpoint_dir", type=str, default=None,
+        help="Checkpoint to this directory in the background: rank 0 writes the model and optimizer, "
+             "every rank its mask shards, MH chain state and RNG state. Use a local disk.")
+    parser.add_argument("--checkpoint_every", type=int, default=1,
+        help="Checkpoint every this many epochs, and after the last one.")
+    parser.add_argument("--resume", default=False, action="store_true",
+        help="Resume training and the MH chain from the checkpoint in --checkpoint_dir.")
     parser.add_argument("--local_rank", type=int, help="get rank of the process")
     parser.add_argument("--pad-data", default=False, action="store_true",
         help="Pad train nid to the same length across machine, to ensure num of batches to be the same.")
     args = parser.parse_args()
+    if args.resume and args.checkpoint_dir is None:
+        parser.error("--resume needs --checkpoint_dir")
 
     for key, value in CONFIG[args.graph_name].items():
         if not hasattr(args, key):
@@ -1,4 +1,5 @@
 import argparse
+import os
 import time
 
 import dgl
@@ -91,6 +92,21 @@ def load_ogb(name, root="dataset"):
     return graph, num_labels
 
 
+def org_ego_sizes(g, num_hop=2):
+    """
+    Ego-graph sizes of every node on the original graph, as counted by mh_aug.
+
+    Column k holds the (k+1)-hop size h_{k+1} = h_k + A h_k with h_0 = 1.
+    """
+    src, dst = g.edges()
+    h = th.ones(g.num_nodes())
+    sizes = []
+    for _ in range(num_hop):
+        h = h + th.zeros_like(h).index_add_(0, dst, h[src])
+        sizes.append(h)
+    return th.stack(sizes, dim=1)
+
+
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser("Partition graph")
     argparser.add_argument(
@@ -132,6 +148,12 @@ if __name__ == "__main__":
         default="data",
         help="Output path of partitioned graph.",
     )
+    argparser.add_argument(
+        "--save_org_ego",
+        action="store_true",
+        help="save ego-graph sizes of the original graph next to the partitions\
+                                for node_classification.py --org_ego_path",
+    )
     args = argparser.parse_args()
 
     start = time.time()
@@ -171,7 +193,7 @@ if __name__ == "__main__":
             sym_g.ndata[key] = g.ndata[key]
         g = sym_g
 
-    dgl.distributed.partition_graph(
+    orig_nids, _ = dgl.distributed.partition_graph(
         g,
         args.dataset,
         args.num_parts,
@@ -180,4 +202,10 @@ if __name__ == "__main__":
         balance_ntypes=balance_ntypes,
         balance_edges=args.balance_edges,
         num_trainers_per_machine=args.num_trainers_per_machine,
+        return_mapping=True,
     )
+
+    if args.save_org_ego:
+        # Partitioning relabels the nodes, so store the sizes in the new node ID order.
+        ego = org_ego_sizes(g)[orig_nids]
+        th.save(ego, os.path.join(args.output, args.dataset + "_org_ego.pt"))
@@ -0,0 +1,29 @@
+#!/bin/bash
+
+# Compare fp32 and bf16 training on CPU (--num_gpus 0). Epoch time and test accuracy of
+# every run are appended to results/<graph_name>.txt, tagged with the precision.
+
+run() {
+    python3 /mnt/shared/development/dgl/juyeong/launch.py \
+    --workspace /mnt/shared/development/dgl/juyeong \
+    --num_trainers 1 \
+    --num_samplers 0 \
+    --num_servers 1 \
+    --part_config "$1" \
+    --ip_config ip_config.txt \
+    "python3 node_classification.py --graph_name $2 --ip_config ip_config.txt --num_gpus 0 $3 --precision $4"
+}
+
+# shellcheck disable=SC2034
+for i in {1..10}
+do
+    for precision in fp32 bf16
+    do
+        run /mnt/shared/development/dgl/juyeong/data/4partition/cora/cora.json \
+            cora "--num_epochs 150 --batch_size 200" $precision
+        run /mnt/shared/development/dgl/juyeong/data/4partition/citeseer/citeseer.json \
+            citeseer "--num_epochs 600 --batch_size 200" $precision
+        run /mnt/shared/data/partitioned/parts4/ogb-product/ogb-product.json \
+            ogb-product "--num_epochs 30 --batch_size 1000" $precision
+    done
+done
@@ -0,0 +1,73 @@
+import math
+
+import torch as th
+import torch.distributed as dist
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+
+from common import metrics
+
+
+class LocalSGD:
+    """
+    Local SGD: every rank takes optimizer steps on its own gradients, and the ranks average
+    their parameters every ``sync_every`` steps instead of all-reducing gradients every step
+
+    Ranks may have different numbers of batches, so parameters are only averaged within
+    the batch count of the rank with the fewest batches, plus once at the end of the epoch.
+    Every rank therefore joins the same number of collectives.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The trained model, without the DDP wrapper.
+    optimizer : torch.optim.Optimizer
+        Its optimizer.
+    sync_every : int
+        Number of local steps between parameter averages.
+    sync_optim_state : bool
+        Also average the optimizer state (e.g. Adam's moment estimates).
+    """
+
+    def __init__(self, model, optimizer, sync_every, sync_optim_state=False):
+        self.model = model
+        self.optimizer = optimizer
+        self.sync_every = sync_every
+        self.sync_optim_state = sync_optim_state
+        self.num_aligned_steps = 0
+
+    def start_epoch(self, num_seeds, batch_size):
+        """
+        Agree on the number of steps every rank takes this epoch.
+        """
+        num_batches = th.tensor([math.ceil(num_seeds / batch_size)])
+        with metrics.timer("train/batch_count_reduce"):
+            dist.all_reduce(num_batches, op=dist.ReduceOp.MIN)
+        self.num_aligned_steps = int(num_batches.item())
+
+    def step(self, step):
+        """
+        Call after the optimizer step of every batch.
+        """
+        if (step + 1) % self.sync_every == 0 and step < self.num_aligned_steps:
+            self.average()
+
+    def end_epoch(self):
+        self.average()
+
+    @th.no_grad()
+    def average(self):
+        params = list(self.model.parameters())
+        tensors = [params]
+        if self.sync_optim_state:
+            # Parameters without a step yet have no state, and are the same on all ranks.
+            for key in ("exp_avg", "exp_avg_sq"):
+                tensors.append([self.optimizer.state[p][key] for p in params if key in self.optimizer.state[p]])
+
+        size = dist.get_world_size()
+        for group in tensors:
+            if len(group) == 0:
+                continue
+            flat = parameters_to_vector(group)
+            with metrics.timer("train/param_average"):
+                dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+            vector_to_parameters(flat / size, group)
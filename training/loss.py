@@ -1,3 +1,4 @@
+import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -94,3 +95,124 @@ class JensenShannon(Loss):
         b = -0.5 * b.sum()
         b = b / num_data
         return b
+
+
+def normalized_entropy(pred):
+    """
+    Prediction entropy of every node, divided by the entropy of a uniform prediction.
+
+    Parameters
+    ----------
+    pred : torch.Tensor
+        Predicted labels.
+
+    Returns
+    -------
+    torch.Tensor of shape (number of nodes,) with values in [0, 1]
+    """
+    max_ent = HLoss()(th.full((1, pred.shape[1]), 1 / pred.shape[1])).item()
+    return HLoss()(pred.detach(), True) / max_ent
+
+
+class FusedLoss(Loss):
+    """
+    Training loss of a step in one pass: cross entropy and consistency loss on the prev
+    predictions, and the entropy regularizer on the org predictions
+
+    Computes the same value and gradients as ``nn.CrossEntropyLoss``, ``XeLoss`` or
+    ``JensenShannon`` and ``HLoss`` together, but takes every log-softmax once and
+    derives the gradients in closed form instead of backpropagating through the softmaxes.
+
+    Parameters
+    ----------
+    n_classes : int
+        Number of classes.
+    kl : float
+        Weight of the consistency loss.
+    h : float
+        Weight of the entropy regularizer.
+    option_loss : int
+        0 for ``XeLoss`` against the one-hot labels, otherwise ``JensenShannon`` between prev and cur.
+    """
+    def __init__(self, n_classes, kl, h, option_loss=0):
+        super(FusedLoss, self).__init__()
+        self.n_classes = n_classes
+        self.kl = kl
+        self.h = h
+        self.option_loss = option_loss
+
+    def forward(self, pred, prev_pred, cur_pred, labels, kl_loss_opt):
+        """
+        Parameters
+        ----------
+        pred : torch.Tensor
+            Predictions on the original graph.
+        prev_pred : torch.Tensor
+            Predictions on the prev view.
+        cur_pred : torch.Tensor
+            Predictions on the cur view.
+        labels : torch.Tensor
+            Ground-truth labels of the seeds.
+        kl_loss_opt : bool
+            With ``JensenShannon``, whether the gradient goes to cur (prev detached) or to prev.
+
+        Returns
+        -------
+        Total loss, and the detached cross entropy, consistency and entropy terms
+        """
+        return _FusedLossFunction.apply(pred, prev_pred, cur_pred, labels, self.n_classes,
+                                        self.kl, self.h, self.option_loss, bool(kl_loss_opt))
+
+
+class _FusedLossFunction(th.autograd.Function):
+    @staticmethod
+    def forward(ctx, pred, prev_pred, cur_pred, labels, n_classes, kl, h, option_loss, kl_loss_opt):
+        log_p = F.log_softmax(pred, dim=1)
+        log_a = F.log_softmax(prev_pred, dim=1)
+        p, a = log_p.exp(), log_a.exp()
+        one_hot = F.one_hot(labels, n_classes).to(prev_pred.dtype)
+
+        loss_xe = -(log_a * one_hot).sum() / len(prev_pred)
+
+        if option_loss == 0:
+            # XeLoss treats the one-hot labels as logits.
+            log_t = F.log_softmax(one_hot, dim=1)
+            t = log_t.exp()
+            loss_kl = (t * (log_t - log_a)).sum() / len(prev_pred)
+            log_c = c = None
+        else:
+            log_c = F.log_softmax(cur_pred, dim=1)
+            c = log_c.exp()
+            loss_kl = 0.5 * ((c - a) * (log_c - log_a)).sum() / len(prev_pred)
+            t = None
+
+        loss_h = -(p * log_p).sum() / len(pred)
+        total = loss_xe + kl * loss_kl + h * loss_h
+
+        ctx.save_for_backward(p, log_p, a, log_a, c, log_c, one_hot, t)
+        ctx.kl, ctx.h, ctx.option_loss, ctx.kl_loss_opt = kl, h, option_loss, kl_loss_opt
+        ctx.mark_non_differentiable(loss_xe, loss_kl, loss_h)
+        return total, loss_xe, loss_kl, loss_h
+
+    @staticmethod
+    def backward(ctx, grad_total, *_):
+        p, log_p, a, log_a, c, log_c, one_hot, t = ctx.saved_tensors
+        num_prev = len(a)
+
+        grad_pred = -ctx.h * p * (log_p - (p * log_p).sum(1, keepdim=True)) / len(p)
+        grad_prev = (a - one_hot) / num_prev
+        grad_cur = None
+
+        if ctx.option_loss == 0:
+            grad_prev = grad_prev + ctx.kl * (a - t) / num_prev
+        elif ctx.kl_loss_opt:
+            # Gradient of KL(prev || cur) + KL(cur || prev) with respect to the cur logits.
+            diff = log_c - log_a
+            grad_cur = 0.5 * ctx.kl * (c * (diff - (c * diff).sum(1, keepdim=True)) + c - a) / num_prev
+        else:
+            diff = log_a - log_c
+            grad_prev = grad_prev + 0.5 * ctx.kl * (a * (diff - (a * diff).sum(1, keepdim=True)) + a - c) / num_prev
+
+        grad_cur = grad_cur * grad_total if grad_cur is not None else None
+        return grad_pred * grad_total, grad_prev * grad_total, grad_cur, None, None, None, None, None, None
+
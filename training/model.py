@@ -5,6 +5,8 @@ import numpy as np
 import torch as th
 import torch.nn as nn
 
+from common import metrics
+
 
 class SAGEConvSUM(dglnn.SAGEConv):
     def __init__(self, in_feats, n_classes):
@@ -15,6 +17,7 @@ class SAGEConvSUM(dglnn.SAGEConv):
         """
         Reset weight parameters as a one
         """
+        nn.init.ones_(self.fc_self.weight)
         nn.init.ones_(self.fc_neigh.weight)
 
     def forward(self, graph, feat, edge_weight=None):
@@ -212,5 +215,6 @@ class DistSAGE(nn.Module):
 
             x = y
             # Synchronize trainers.
-            g.barrier()
+            with metrics.timer("eval/barrier"):
+                g.barrier()
         return x